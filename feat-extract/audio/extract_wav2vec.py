@@ -1,64 +1,217 @@
-import soundfile as sf
 import torch
-from transformers import Wav2Vec2Model, Wav2Vec2Processor, Wav2Vec2ForCTC
 import numpy as np
 import os
+import copy
+import time
 import subprocess
 from os import path
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import argparse
+import sys
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', '..', 'src'))
+from instrument import metrics
+
+SAMPLE_RATE = 16000 # what wav2vec2-base-960h was trained on
+MODEL = 'facebook/wav2vec2-base-960h'
+
+def perror(msg):
+	""" Print error and exit. """
+	print(f'Error: {msg}')
+	exit(1)
 
 # `conda activate test`
 
-def main():
-	args = parse_args()
+def main(argv=None):
+	args = parse_args(argv)
+	torch.set_num_threads(args.threads)
+
+	if args.check_parity:
+		check_parity(args.batch_size)
+		return
+	if args.check_chunking:
+		check_chunking(args.chunk_frames or 200, args.chunk_overlap, args.batch_size)
+		return
 
 	# load model and tokenizer
-	tokenizer, model = load_model()
+	tokenizer, model = load_model(args.model)
+	if args.check_accuracy:
+		files = sorted(os.listdir(args.audio_path))[:args.check_accuracy]
+		check_accuracy(args, tokenizer, model, [os.path.join(args.audio_path, f) for f in files])
+		return
+	model = fast_model(model, args.quantize, args.compile)
+	if args.metrics or args.profile:
+		metrics.configure(args.metrics, args.profile, args.profile_every,
+			path.join(args.feat_path, 'profiles'))
 
-	for f in tqdm(os.listdir(args.audio_path)):
-		f_path = os.path.join(args.audio_path, f)
-		f_wav_path = os.path.join(args.audio_path, f.replace('.mp3', '.wav'))
+	todo = []
+	for f in sorted(os.listdir(args.audio_path)):
 		out_feat_path = os.path.join(args.feat_path, f.replace('.mp3', '.npy'))
+		if not path.isfile(out_feat_path):
+			todo.append(f)
+
+	def decode(f):
+		with metrics.timer('decode', path.splitext(f)[0]):
+			return decode_audio(os.path.join(args.audio_path, f), args.sample_rate)
+	decoded = prefetch(decode, todo, args.decode_workers, args.prefetch)
+
+	with autocast(args.bf16):
+		if args.batch_size > 1:
+			extract_batched(args, tokenizer, model, decoded, len(todo))
+			metrics.print_summary()
+			return
+
+		for i, (f, data) in enumerate(tqdm(decoded, total=len(todo))):
+			out_feat_path = os.path.join(args.feat_path, f.replace('.mp3', '.npy'))
+			try:
+				with metrics.profiled(path.splitext(f)[0]):
+					extract_wav2vec(tokenizer, model, data, out_feat_path,
+						args.chunk_frames, args.chunk_overlap)
+			except Exception as e:
+				print(e)
+				metrics.count('failures')
+				metrics.print_summary()
+				exit()
+			if i % 64 == 63: metrics.flush()
+	metrics.print_summary()
+
+
+def extract_batched(args, tokenizer, model, decoded, total):
+	""" Take decoded clips a window at a time and run length-sorted batches through the model. """
+	window = args.batch_size * args.sort_window
+	with tqdm(total=total) as bar:
+		while True:
+			inputs = [(f, preprocess(tokenizer, data)) for f, data in islice(decoded, window)]
+			if not inputs: break
+			with metrics.profiled(path.splitext(inputs[0][0])[0]):
+				extract_window(args, model, inputs, bar)
+			metrics.flush()
 
-		if out_feat_path in os.listdir(args.feat_path):
-			continue
 
-		mp3_to_wav(f_path, f_wav_path)
-		try:
-			extract_wav2vec(tokenizer, model, f_wav_path, out_feat_path)
-		except Exception as e:
-			print(e)
-			os.remove(f_wav_path)
-			exit()
-		os.remove(f_wav_path)
+def extract_window(args, model, inputs, bar):
+	""" Run a window of preprocessed clips through the model and save their features. """
+	# long clips run on their own, a batch of chunks at a time
+	if args.chunk_frames:
+		long = [(f, x) for f, x in inputs if num_frames(model, x) > args.chunk_frames]
+		inputs = [(f, x) for f, x in inputs if num_frames(model, x) <= args.chunk_frames]
+		for f, x in long:
+			with metrics.timer('inference', path.splitext(f)[0]):
+				feats = postprocess(hidden_states_chunked(model, x, args.chunk_frames,
+					args.chunk_overlap, args.batch_size))
+			save_feats(feats, os.path.join(args.feat_path, f.replace('.mp3', '.npy')))
+			bar.update(1)
 
+	# neighbours in length share a batch, so little of it is padding
+	inputs.sort(key=lambda x: x[1].shape[0])
+	for i in range(0, len(inputs), args.batch_size):
+		batch = inputs[i:i + args.batch_size]
+		# a batch is one observation, under the id of its first clip
+		with metrics.timer('inference', path.splitext(batch[0][0])[0]):
+			feats = extract_wav2vec_batch(model, [x for _, x in batch])
+		for (f, _), feat in zip(batch, feats):
+			save_feats(feat, os.path.join(args.feat_path, f.replace('.mp3', '.npy')))
+		bar.update(len(batch))
 
-def parse_args():
+
+def parse_args(argv=None):
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-a', '--audio_path',  type=str, default='../data/audio',
 		help='dir path of input audio files') 
 	parser.add_argument('-f', '--feat_path',  type=str, default='../features/audio',
 		help='dir path of output features') 
-	return parser.parse_args()
+	parser.add_argument('-b', '--batch_size',  type=int, default=1,
+		help='clips per forward pass; 1 keeps the single-clip path')
+	parser.add_argument('--sort_window',  type=int, default=8,
+		help='batches worth of clips read ahead and sorted by length')
+	parser.add_argument('-r', '--sample_rate',  type=int, default=SAMPLE_RATE,
+		help='decode audio at this rate; 0 keeps the native rate of the mp3')
+	parser.add_argument('--decode_workers',  type=int, default=4,
+		help='threads decoding audio ahead of the model')
+	parser.add_argument('--prefetch',  type=int, default=64,
+		help='max clips decoded ahead of the model')
+	parser.add_argument('-j', '--threads',  type=int, default=torch.get_num_threads(),
+		help='intra-op threads used by torch')
+	parser.add_argument('--check_parity', action='store_true',
+		help='compare batched and single-clip features on a tiny random model and exit')
+	parser.add_argument('--chunk_frames',  type=int, default=0,
+		help='run clips longer than this many output frames in overlapping chunks; 0 for off')
+	parser.add_argument('--chunk_overlap',  type=int, default=50,
+		help='frames of context each chunk shares with its neighbours on each side')
+	parser.add_argument('--check_chunking', action='store_true',
+		help='compare chunked and full-clip features on a tiny random model and exit')
+	parser.add_argument('-m', '--model',  type=str, default=MODEL,
+		help='hub name, or a local dir saved with save_pretrained, which loads offline')
+	parser.add_argument('--quantize', action='store_true',
+		help='dynamic int8 quantization of the linear layers')
+	parser.add_argument('--bf16', action='store_true',
+		help='run the model under bf16 autocast')
+	parser.add_argument('--compile', action='store_true',
+		help='torch.compile the conv feature encoder and the transformer')
+	parser.add_argument('--check_accuracy',  type=int, default=0,
+		help='compare the fast mode and chunking with fp32 on this many clips of audio_path and exit')
+	parser.add_argument('--min_cosine',  type=float, default=0.99,
+		help='fail the accuracy check if a clip has a lower mean cosine similarity')
+	parser.add_argument('--metrics',  type=str, default='',
+		help='write per-clip decode, inference and save timings to this jsonl file, or a .prom textfile')
+	parser.add_argument('--profile',  type=str, default='', choices=['', 'cprofile', 'tracemalloc'],
+		help='profile sampled clips (windows when batched); written under feat_path/profiles/')
+	parser.add_argument('--profile_every',  type=int, default=100,
+		help='profile one in this many clips, or windows')
+	args = parser.parse_args(argv)
+	if args.quantize and args.bf16:
+		perror('--quantize and --bf16 do not combine: int8 dynamic linear layers take fp32 inputs')
+	return args
 
-def load_model():
-	tokenizer = Wav2Vec2Processor.from_pretrained("facebook/wav2vec2-base-960h")
-	model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-base-960h")
+def load_model(name=MODEL):
+	# transformers takes seconds to import, so only the paths that build a model load it
+	from transformers import Wav2Vec2Model, Wav2Vec2FeatureExtractor
+	local = path.isdir(name)
+	tokenizer = Wav2Vec2FeatureExtractor.from_pretrained(name, local_files_only=local)
+	model = Wav2Vec2Model.from_pretrained(name, local_files_only=local).eval()
 	print('Loaded model --------------------------------------------')
 	return tokenizer, model
 
-""" Step 1: Extracts audio at the native sampling rate into a separate wav file """
-def mp3_to_wav(input_file, output_file):
-	subprocess.call(['ffmpeg', '-y', '-i', input_file, output_file,
-					 '-hide_banner', '-loglevel', 'error'])
+def fast_model(model, quantize=False, compile=False):
+	""" Model with int8 dynamic quantized linear layers and/or compiled submodules. """
+	if quantize:
+		model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+	if compile:
+		# the batched path calls these two directly, rather than model()
+		model.feature_extractor = torch.compile(model.feature_extractor, dynamic=True)
+		model.encoder = torch.compile(model.encoder, dynamic=True)
+	return model
+
+def autocast(bf16):
+	return torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16)
+
+""" Step 1: Decodes audio to mono samples straight from ffmpeg's stdout """
+def decode_audio(input_file, samplerate=SAMPLE_RATE):
+	cmd = ['ffmpeg', '-i', input_file, '-f', 'f32le', '-ac', '1']
+	if samplerate: cmd += ['-ar', str(samplerate)]
+	cmd += ['-hide_banner', '-loglevel', 'error', 'pipe:1']
+	proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if proc.returncode != 0:
+		raise RuntimeError(f'ffmpeg failed on {input_file}: {proc.stderr.decode().strip()}')
+	return np.frombuffer(proc.stdout, dtype=np.float32).astype(np.float64)
 
-def extract_wav2vec(tokenizer, model, input_file, output_file):
-	data, samplerate = sf.read(input_file)
-	if len(data.shape) > 1: 
-		data = data[:,0] + data[:,1]
-	data += np.zeros(1)
+def prefetch(func, items, workers, depth):
+	""" Yield (item, func(item)) in order, with up to depth calls running ahead. """
+	with ThreadPoolExecutor(workers) as executor:
+		futures = deque()
+		for item in items:
+			futures.append((item, executor.submit(func, item)))
+			if len(futures) >= depth:
+				item, future = futures.popleft()
+				yield item, future.result()
+		while futures:
+			item, future = futures.popleft()
+			yield item, future.result()
 
+def preprocess(tokenizer, data):
+	""" Normalize, mean-pool every 10 samples and append 320 zeros (1-D tensor). """
 	input_values = tokenizer(data, return_tensors="pt").input_values
 
 	input_values = input_values \
@@ -68,16 +221,189 @@ def extract_wav2vec(tokenizer, model, input_file, output_file):
 
 	padder = torch.zeros(1, 320)
 	input_values = torch.cat([input_values, padder], dim = 1)
-	feats = model(input_values)
-	feats = feats.last_hidden_state[0]
+	return input_values[0]
+
+def postprocess(feats):
+	""" Average the (frames, dim) output over 5 consecutive chunks of time. """
+	feats = feats.float()
+	dim = feats.shape[1]
 	size = feats.shape[0] // 5
-	feats = feats.flatten()[:(5*size*768)]
-	feats = feats.reshape(5, size, 768)
-	feats = torch.mean(feats, axis=0).reshape(size, 768)
-	feats = feats.detach().cpu().numpy()
-	with open( output_file, 'wb') as f:
-		np.save(f, feats)
+	feats = feats.flatten()[:(5*size*dim)]
+	feats = feats.reshape(5, size, dim)
+	feats = torch.mean(feats, axis=0).reshape(size, dim)
+	return feats.detach().cpu().numpy()
+
+def save_feats(feats, output_file):
+	with metrics.timer('save', path.splitext(path.basename(output_file))[0]):
+		with open( output_file, 'wb') as f:
+			np.save(f, feats)
+
+def extract_wav2vec(tokenizer, model, data, output_file, chunk_frames=0, overlap=0):
+	input_values = preprocess(tokenizer, data)
+	with metrics.timer('inference', path.splitext(path.basename(output_file))[0]):
+		if chunk_frames and num_frames(model, input_values) > chunk_frames:
+			feats = postprocess(hidden_states_chunked(model, input_values, chunk_frames, overlap))
+		else:
+			with torch.inference_mode():
+				feats = postprocess(model(input_values[None]).last_hidden_state[0])
+	save_feats(feats, output_file)
+
+def extract_wav2vec_batch(model, inputs):
+	""" Features for a list of preprocessed clips with one padded encoder pass. """
+	return [postprocess(h) for h in hidden_states_batch(model, inputs)]
+
+@torch.inference_mode()
+def hidden_states_batch(model, inputs):
+	""" Encoder outputs (frames, dim) of a list of preprocessed clips, in one padded pass.
+
+	The conv feature encoder runs per clip: wav2vec2-base group-normalizes its
+	first conv layer over time, so zero padding would leak into the clip's
+	statistics. Its outputs are then padded and masked for the transformer.
+	"""
+	convs = [model.feature_extractor(x[None])[0].transpose(0, 1) for x in inputs]
+	lengths = torch.tensor([c.shape[0] for c in convs])
+	extract_features = torch.nn.utils.rnn.pad_sequence(convs, batch_first=True)
+	mask = torch.arange(extract_features.shape[1])[None] < lengths[:, None]
+
+	hidden_states, _ = model.feature_projection(extract_features)
+	hidden_states = model.encoder(hidden_states, attention_mask=mask).last_hidden_state
+	if model.adapter is not None:
+		hidden_states = model.adapter(hidden_states)
+	return [hidden_states[i, :n] for i, n in enumerate(lengths.tolist())]
+
+def conv_geometry(config):
+	""" Stride and receptive field, in input samples, of the conv feature encoder. """
+	stride, field = 1, 1
+	for kernel, s in zip(config.conv_kernel, config.conv_stride):
+		field += (kernel - 1) * stride
+		stride *= s
+	return stride, field
+
+def num_frames(model, x):
+	stride, field = conv_geometry(model.config)
+	return max(0, (x.shape[0] - field) // stride + 1)
+
+def hidden_states_chunked(model, x, chunk_frames, overlap, batch_size=1):
+	""" Encoder output (frames, dim) of a long preprocessed clip, chunk_frames at a time.
+
+	Chunks overlap their neighbours by overlap frames on each side and only
+	their central frames are kept, so every kept frame has at least overlap
+	frames of context. Chunks run batch_size at a time, so peak memory depends
+	on chunk_frames and batch_size, not on the clip length. Clips of at most
+	chunk_frames frames run in one pass, exactly as without chunking.
+	"""
+	stride, field = conv_geometry(model.config)
+	total = num_frames(model, x)
+	if total <= chunk_frames: return hidden_states_batch(model, [x])[0]
+	hop = chunk_frames - 2 * overlap
+	if hop <= 0: perror(f'chunk of {chunk_frames} frames has no room for {overlap} frames of overlap')
+
+	# (first, last) input frames and (start, stop) kept frames of every chunk
+	spans = []
+	for start in range(0, total, hop):
+		stop = min(start + hop, total)
+		spans.append((max(0, start - overlap), min(total, stop + overlap), start, stop))
+	out = []
+	for i in range(0, len(spans), batch_size):
+		group = spans[i:i + batch_size]
+		chunks = [x[first * stride:(last - 1) * stride + field] for first, last, _, _ in group]
+		for (first, _, start, stop), h in zip(group, hidden_states_batch(model, chunks)):
+			out.append(h[start - first:stop - first])
+	return torch.cat(out)
+
+def check_accuracy(args, tokenizer, model, files):
+	""" Cosine similarity of fast mode (and/or chunked) features to fp32 full-clip ones. """
+	fast = fast_model(copy.deepcopy(model), args.quantize, args.compile)
+	inputs = [preprocess(tokenizer, decode_audio(f, args.sample_rate)) for f in files]
+	if not inputs: perror(f'no clips in {args.audio_path}')
+
+	@torch.inference_mode()
+	def run(model, x, bf16, chunk_frames=0):
+		with autocast(bf16):
+			if chunk_frames:
+				return postprocess(hidden_states_chunked(model, x, chunk_frames, args.chunk_overlap))
+			return postprocess(model(x[None]).last_hidden_state[0])
+
+	# warm up, which also compiles
+	run(model, inputs[0], False)
+	run(fast, inputs[0], args.bf16, args.chunk_frames)
+	sims, seconds = [], [0., 0.]
+	for x in inputs:
+		start = time.time()
+		ref = run(model, x, False)
+		seconds[0] += time.time() - start
+		start = time.time()
+		feats = run(fast, x, args.bf16, args.chunk_frames)
+		seconds[1] += time.time() - start
+		sims.append(cosine_similarity(ref, feats))
+
+	clip_sims = np.array([s.mean() for s in sims])
+	print(f'cosine similarity to fp32 over {len(inputs)} clips: mean {clip_sims.mean():.5f}, '
+		f'worst clip {clip_sims.min():.5f}, worst frame {min(s.min() for s in sims):.5f}')
+	print(f'fp32 {seconds[0]:.2f}s, fast mode {seconds[1]:.2f}s: {seconds[0] / seconds[1]:.2f}x')
+	if clip_sims.min() < args.min_cosine:
+		perror(f'a clip has cosine similarity below {args.min_cosine}')
+
+def tiny_model(**kwargs):
+	""" A small random wav2vec2 and feature extractor, for the self checks. """
+	from transformers import Wav2Vec2Config, Wav2Vec2Model, Wav2Vec2FeatureExtractor
+	torch.manual_seed(0)
+	config = dict(hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+		intermediate_size=64, conv_dim=(32, 32, 32), conv_stride=(5, 2, 2),
+		conv_kernel=(10, 3, 3), num_conv_pos_embeddings=16,
+		num_conv_pos_embedding_groups=4)
+	config = Wav2Vec2Config(**{**config, **kwargs})
+	return Wav2Vec2FeatureExtractor(), Wav2Vec2Model(config).eval()
+
+def check_chunking(chunk_frames, overlap, batch_size, atol=1e-4):
+	""" Compare chunked and full-clip features of clips up to 8 chunks long.
+
+	A model whose context is local (per-frame conv norm, no attention layers)
+	must give the same features either way, which checks the stitching. The
+	tiny random model with group norm and attention is only reported: how
+	close chunking gets depends on how far the model's attention reaches, so
+	for a real model use --check_accuracy with --chunk_frames.
+	"""
+	models = {'local': tiny_model(feat_extract_norm='layer', do_stable_layer_norm=True,
+		num_hidden_layers=0), 'attention': tiny_model()}
+	rng = np.random.default_rng(0)
+	for name, (tokenizer, model) in models.items():
+		stride, field = conv_geometry(model.config)
+		for chunks in [0.5, 1, 2, 4, 8]:
+			# preprocess pools 10 samples into one
+			x = preprocess(tokenizer, rng.standard_normal(int(chunks * chunk_frames * stride * 10)))
+			with torch.inference_mode():
+				ref = postprocess(model(x[None]).last_hidden_state[0])
+			feats = postprocess(hidden_states_chunked(model, x, chunk_frames, overlap, batch_size))
+			err = np.abs(ref - feats).max()
+			print(f'{name} model, {num_frames(model, x)} frames: max abs diff {err:.2e}, '
+				f'min cosine {cosine_similarity(ref, feats).min():.5f}')
+			if name == 'local' and err > atol: perror(f'chunked features differ by more than {atol}')
+
+def cosine_similarity(a, b):
+	""" Per-frame cosine similarity of two (frames, dim) arrays. """
+	norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+	return (a * b).sum(axis=1) / np.maximum(norms, 1e-12)
+
+def check_parity(batch_size, num_clips=12, atol=1e-4):
+	""" Compare batched and single-clip features with a tiny random model. """
+	tokenizer, model = tiny_model()
+
+	rng = np.random.default_rng(0)
+	inputs = [preprocess(tokenizer, rng.standard_normal(rng.integers(24000, 120000)))
+		for _ in range(num_clips)]
+	inputs.sort(key=lambda x: x.shape[0])
+
+	err = 0.
+	for i in range(0, num_clips, max(batch_size, 2)):
+		batch = inputs[i:i + max(batch_size, 2)]
+		for x, feats in zip(batch, extract_wav2vec_batch(model, batch)):
+			with torch.inference_mode():
+				ref = postprocess(model(x[None]).last_hidden_state[0])
+			err = max(err, float(np.abs(ref - feats).max()))
+	print(f'max abs diff batched vs single-clip: {err:.2e}')
+	if err > atol: perror(f'batched features differ by more than {atol}')
 
 
 if __name__ == '__main__':
-	main()
+	main()
\ No newline at end of file
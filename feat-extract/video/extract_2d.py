@@ -0,0 +1,242 @@
+import torch
+import numpy as np
+import os
+import sys
+import threading
+import subprocess
+from os import path
+from queue import Queue
+from tqdm import tqdm
+import argparse
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', '..', 'src'))
+from instrument import metrics
+
+SIZE = 224 # input side of the torchvision ImageNet models
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+BACKBONE = 'resnet50'
+
+def perror(msg):
+	""" Print error and exit. """
+	print(f'Error: {msg}')
+	exit(1)
+
+def main(argv=None):
+	args = parse_args(argv)
+	torch.set_num_threads(args.threads)
+
+	if args.check_parity:
+		check_parity(args.batch_size, args.stride, args.size)
+		return
+
+	model = load_backbone(args.backbone, args.weights)
+	if args.metrics or args.profile:
+		metrics.configure(args.metrics, args.profile, args.profile_every,
+			path.join(args.feat_path, 'profiles'))
+	os.makedirs(args.feat_path, exist_ok=True)
+
+	todo = [f for f in sorted(os.listdir(args.video_path)) if f.endswith('.mp4')
+		and not path.isfile(path.join(args.feat_path, f.replace('.mp4', '.npy')))]
+
+	def decode(f):
+		with metrics.timer('decode', path.splitext(f)[0]):
+			return decode_video(path.join(args.video_path, f), args.stride, args.size)
+
+	failed = []
+	with tqdm(total=len(todo)) as bar:
+		def save(f, feats):
+			with metrics.timer('save', path.splitext(f)[0]):
+				save_feats(feats, path.join(args.feat_path, f.replace('.mp4', '.npy')))
+			bar.update(1)
+
+		def decoded():
+			for f, frames in decode_stage(todo, decode, args.decode_workers, args.prefetch):
+				if isinstance(frames, Exception) or len(frames) == 0:
+					print(frames if isinstance(frames, Exception) else f'{f}: no frames')
+					metrics.count('failures')
+					failed.append(f)
+					bar.update(1)
+					continue
+				yield f, frames
+
+		extract_frames(model, decoded(), args.batch_size, save)
+	if failed: print(f'{len(failed)} clips failed, e.g. {failed[0]}')
+	metrics.print_summary()
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-v', '--video_path',  type=str, default='../data/video',
+		help='dir path of input mp4 files')
+	parser.add_argument('-f', '--feat_path',  type=str, default='../features/video',
+		help='dir path of output features, one (frames, dim) float32 npy per clip')
+	parser.add_argument('-s', '--stride',  type=int, default=1,
+		help='keep every stride-th frame of a clip')
+	parser.add_argument('--size',  type=int, default=SIZE,
+		help='frames are scaled to size x size by ffmpeg')
+	parser.add_argument('-b', '--batch_size',  type=int, default=64,
+		help='frames per forward pass; a batch spans as many clips as it takes to fill it')
+	parser.add_argument('--decode_workers',  type=int, default=4,
+		help='threads, each running one ffmpeg decode at a time')
+	parser.add_argument('--prefetch',  type=int, default=16,
+		help='max decoded clips waiting for the model')
+	parser.add_argument('-j', '--threads',  type=int, default=torch.get_num_threads(),
+		help='intra-op threads used by torch')
+	parser.add_argument('-m', '--backbone',  type=str, default=BACKBONE,
+		help='a torchvision classification model, with its classifier removed, or tiny '
+			'for a small random network that needs no weights')
+	parser.add_argument('-w', '--weights',  type=str, default='',
+		help='state dict file of the backbone, for offline use; empty for the torchvision weights')
+	parser.add_argument('--check_parity', action='store_true',
+		help='compare batched and single-clip features on the tiny backbone and exit')
+	parser.add_argument('--metrics',  type=str, default='',
+		help='write per-clip decode, inference and save timings to this jsonl file, or a .prom textfile')
+	parser.add_argument('--profile',  type=str, default='', choices=['', 'cprofile', 'tracemalloc'],
+		help='profile sampled batches; written under feat_path/profiles/')
+	parser.add_argument('--profile_every',  type=int, default=100,
+		help='profile one in this many batches')
+	return parser.parse_args(argv)
+
+def load_backbone(name=BACKBONE, weights=''):
+	""" An eval mode model from (N, 3, H, W) normalized frames to (N, dim) features. """
+	if name == 'tiny': model = tiny_backbone()
+	else:
+		import torchvision
+		model = torchvision.models.get_model(name, weights=None if weights else 'DEFAULT')
+		if weights: model.load_state_dict(torch.load(weights, map_location='cpu'))
+		# keep the pooled features in front of the classifier
+		for attr in ['fc', 'classifier', 'head', 'heads']:
+			if hasattr(model, attr):
+				setattr(model, attr, torch.nn.Identity())
+				break
+		else: perror(f'{name} has no classifier to remove')
+	print('Loaded backbone -----------------------------------------')
+	return model.eval()
+
+def tiny_backbone(dim=32):
+	""" A small random conv net, for tests and offline runs. """
+	torch.manual_seed(0)
+	nn = torch.nn
+	return nn.Sequential(
+		nn.Conv2d(3, 16, 7, stride=4, padding=3), nn.BatchNorm2d(16), nn.ReLU(),
+		nn.Conv2d(16, dim, 3, stride=2, padding=1), nn.BatchNorm2d(dim), nn.ReLU(),
+		nn.AdaptiveAvgPool2d(1), nn.Flatten()).eval()
+
+""" Step 1: Decodes every stride-th frame, scaled to size x size, straight from ffmpeg's stdout """
+def decode_video(input_file, stride=1, size=SIZE):
+	frame_bytes = size * size * 3
+	vf = f'select=not(mod(n\\,{stride})),scale={size}:{size}' if stride > 1 else f'scale={size}:{size}'
+	cmd = ['ffmpeg', '-i', input_file, '-vf', vf, '-fps_mode', 'passthrough', '-f', 'rawvideo',
+		'-pix_fmt', 'rgb24', '-hide_banner', '-loglevel', 'error', 'pipe:1']
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	frames = []
+	# read a frame at a time, so only one copy of the clip is ever held
+	while True:
+		frame = proc.stdout.read(frame_bytes)
+		if len(frame) < frame_bytes: break
+		frames.append(np.frombuffer(frame, dtype=np.uint8).reshape(size, size, 3))
+	err = proc.stderr.read()
+	if proc.wait() != 0:
+		raise RuntimeError(f'ffmpeg failed on {input_file}: {err.decode().strip()}')
+	return np.stack(frames) if frames else np.empty((0, size, size, 3), dtype=np.uint8)
+
+def decode_stage(items, func, workers, depth):
+	""" Yield (item, func(item)) as worker threads finish them, in any order.
+
+	Results wait in a queue of at most depth items, so the workers block when
+	the consumer falls behind. An exception of func is yielded as the result.
+	"""
+	queue = Queue(depth)
+	items, lock = iter(items), threading.Lock()
+
+	def work():
+		while True:
+			with lock: item = next(items, None)
+			if item is None: break
+			try:
+				out = func(item)
+			except Exception as e:
+				out = e
+			queue.put((item, out))
+		queue.put(None)
+
+	for _ in range(workers):
+		threading.Thread(target=work, daemon=True).start()
+	running = workers
+	while running:
+		out = queue.get()
+		if out is None: running -= 1
+		else: yield out
+
+""" Step 2: Runs frames through the backbone, batched across clips """
+def extract_frames(model, clips, batch_size, save):
+	""" Run the frames of (name, (F, H, W, 3) uint8) clips through model batch_size at a time.
+
+	A batch takes frames from as many clips as it needs to fill up, and
+	save(name, (F, dim) float32) is called as soon as all of a clip's frames
+	are done.
+	"""
+	batch, owners = [], [] # frame slices of the next batch and the clip of each
+	feats = dict() # name -> [feature slices, frames left]
+	queued = 0
+
+	def run():
+		id = path.splitext(owners[0])[0]
+		with metrics.profiled(id), metrics.timer('inference', id):
+			out = forward(model, np.concatenate(batch))
+		offset = 0
+		for name, x in zip(owners, batch):
+			clip = feats[name]
+			clip[0].append(out[offset:offset + len(x)])
+			clip[1] -= len(x)
+			offset += len(x)
+			if clip[1] == 0: save(name, np.concatenate(feats.pop(name)[0]))
+		batch.clear()
+		owners.clear()
+
+	for name, frames in clips:
+		feats[name] = [[], len(frames)]
+		start = 0
+		while start < len(frames):
+			x = frames[start:start + batch_size - queued]
+			batch.append(x)
+			owners.append(name)
+			queued += len(x)
+			start += len(x)
+			if queued == batch_size:
+				run()
+				queued = 0
+	if batch: run()
+
+@torch.inference_mode()
+def forward(model, frames):
+	""" (N, dim) float32 features of (N, H, W, 3) uint8 frames. """
+	x = (frames.astype(np.float32) / 255 - MEAN) / STD
+	x = torch.from_numpy(x).permute(0, 3, 1, 2)
+	return model(x).float().numpy()
+
+def save_feats(feats, output_file):
+	""" Written to a tmp file and renamed, so an interrupted run leaves no partial features. """
+	tmp_file = output_file + '.tmp'
+	with open(tmp_file, 'wb') as f:
+		np.save(f, feats.astype(np.float32))
+	os.replace(tmp_file, output_file)
+
+def check_parity(batch_size, stride, size, num_clips=7, atol=1e-5):
+	""" Features batched across clips must equal those of each clip on its own. """
+	model = tiny_backbone()
+	rng = np.random.default_rng(0)
+	clips = [(f'clip{i}', rng.integers(0, 256, (rng.integers(1, 3 * batch_size), size, size, 3),
+		dtype=np.uint8)[::stride]) for i in range(num_clips)]
+	batched = dict()
+	extract_frames(model, clips, batch_size, batched.__setitem__)
+	worst = 0.
+	for name, frames in clips:
+		single = forward(model, frames)
+		if batched[name].shape != single.shape: perror(f'{name}: shape {batched[name].shape} != {single.shape}')
+		worst = max(worst, float(np.abs(batched[name] - single).max()))
+	print(f'{num_clips} clips, batch of {batch_size} frames: max abs diff {worst:.2e}')
+	if worst > atol: perror(f'batched features differ by more than {atol}')
+
+if __name__ == '__main__':
+	main()
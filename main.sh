@@ -1,9 +1,13 @@
 #!/bin/bash
 
-python main.py -d ./data/disjoint/
+WORKERS=${WORKERS:-$(nproc)}
+TTS=${TTS:-gtts}
+TTS_CACHE=./data/tts_cache/
 
-python main.py -d ./data/overlap/
+python main.py -d ./data/disjoint/ -w $WORKERS --tts $TTS --tts_cache $TTS_CACHE
 
-python main.py -d ./data/subset/
+python main.py -d ./data/overlap/ -w $WORKERS --tts $TTS --tts_cache $TTS_CACHE
 
-python main.py -d ./data/same/
\ No newline at end of file
+python main.py -d ./data/subset/ -w $WORKERS --tts $TTS --tts_cache $TTS_CACHE
+
+python main.py -d ./data/same/ -w $WORKERS --tts $TTS --tts_cache $TTS_CACHE
\ No newline at end of file
@@ -0,0 +1,16 @@
+#!/bin/bash
+# Generate one dataset with SHARDS processes standing in for nodes, then merge.
+# On a cluster, run the main.py line once per node with its own --shard.
+
+DATA=${DATA:-./data/same/}
+SHARDS=${SHARDS:-4}
+WORKERS=${WORKERS:-1}
+TTS=${TTS:-gtts}
+TTS_CACHE=./data/tts_cache/
+
+for i in $(seq 0 $((SHARDS - 1))); do
+	python main.py -d $DATA --shard $i --num_shards $SHARDS -w $WORKERS --tts $TTS --tts_cache $TTS_CACHE &
+done
+wait
+
+python merge_shards.py -d $DATA
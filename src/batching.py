@@ -0,0 +1,162 @@
+import numpy as np
+import os.path as op
+import argparse
+import pickle
+
+from feature_store import MODALITIES
+
+
+def lengths_file(records):
+	""" The length index of a create_pickle.py pickle, or the index.npz of a shards dir. """
+	if op.isdir(records): return op.join(records, 'index.npz')
+	return op.splitext(records)[0] + '_lengths.npz'
+
+
+def write_lengths(lengths_file, records):
+	""" Index the ids and per-modality frame counts of in-memory records. """
+	arrays = {'id': np.array([r['id'] for r in records], dtype=str)}
+	for m in MODALITIES:
+		arrays[f'{m}_length'] = np.array([len(r[m]) for r in records], dtype=np.int64)
+	np.savez(lengths_file, **arrays)
+
+
+def load_lengths(records):
+	""" ids and (N, len(MODALITIES)) frame counts of a pickle or shards dir.
+
+	The index of an older pickle is built, and written next to it, on first use.
+	"""
+	index_file = lengths_file(records)
+	if not op.isfile(index_file):
+		with open(records, 'rb') as rf: write_lengths(index_file, pickle.load(rf))
+	with np.load(index_file) as index:
+		return index['id'], np.stack([index[f'{m}_length'] for m in MODALITIES], axis=1)
+
+
+class BucketBatchSampler:
+	""" Batches of record indices of similar length, to cut padding.
+
+	Every epoch the records are shuffled, cut into pools of pool_batches
+	batches, and each pool is sorted by length (summed over modalities) and
+	cut into batches; the batches are then shuffled. Bigger pools pad less but
+	mix less. Without shuffle, all records are sorted once, for evaluation.
+	"""
+
+	def __init__(self, lengths, batch_size, pool_batches=50, shuffle=True, drop_last=False, seed=0):
+		lengths = np.asarray(lengths)
+		self.key = lengths.reshape(len(lengths), -1).sum(axis=1)
+		self.batch_size, self.pool_batches = batch_size, pool_batches
+		self.shuffle, self.drop_last = shuffle, drop_last
+		self.seed, self.epoch = seed, 0
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def batches(self):
+		n, size = len(self.key), self.batch_size
+		if not self.shuffle:
+			order = np.argsort(self.key, kind='stable')
+			return self.cut(order)
+		rng = np.random.default_rng([self.seed, self.epoch])
+		order = rng.permutation(n)
+		pool = size * self.pool_batches
+		batches = []
+		for start in range(0, n, pool):
+			chunk = order[start:start + pool]
+			batches += self.cut(chunk[np.argsort(self.key[chunk], kind='stable')])
+		return [batches[i] for i in rng.permutation(len(batches))]
+
+	def cut(self, order):
+		size = self.batch_size
+		stop = len(order) - len(order) % size if self.drop_last else len(order)
+		return [order[i:i + size] for i in range(0, stop, size)]
+
+	def __iter__(self):
+		return iter(self.batches())
+
+	def __len__(self):
+		n = len(self.key)
+		if self.drop_last: return n // self.batch_size
+		# pools cut separately may each leave a partial batch
+		pool = self.batch_size * self.pool_batches if self.shuffle else n
+		full, rest = divmod(n, pool)
+		return full * -(-pool // self.batch_size) + -(-rest // self.batch_size)
+
+
+def random_batches(n, batch_size, seed=0):
+	order = np.random.default_rng(seed).permutation(n)
+	return [order[i:i + batch_size] for i in range(0, n, batch_size)]
+
+
+def padded_frames(lengths, batches):
+	""" Frames per modality once every batch is padded to its longest record. """
+	lengths = np.asarray(lengths)
+	return sum(len(b) * lengths[b].max(axis=0) for b in batches)
+
+
+class Collator:
+	""" Pack records into padded (batch, frames, ...) arrays with masks.
+
+	Buffers are allocated once, grown to the biggest batch seen, and reused:
+	the returned arrays are views that the next call overwrites, so copy
+	them to keep them. Every modality gets {m}, {m}_mask (batch, frames) and
+	{m}_length arrays; records are packed with one masked assignment, with
+	no copy per record. Records with caption ids also get a caption_id array.
+	"""
+
+	def __init__(self, modalities=MODALITIES):
+		self.modalities = modalities
+		self.buffers, self.masks = dict(), dict()
+
+	def buffer(self, m, batch, frames, trailing, dtype):
+		buf = self.buffers.get(m)
+		if buf is None or buf.shape[2:] != trailing or buf.dtype != dtype \
+				or buf.shape[0] < batch or buf.shape[1] < frames:
+			if buf is not None and buf.shape[2:] == trailing and buf.dtype == dtype:
+				batch, frames = max(batch, buf.shape[0]), max(frames, buf.shape[1])
+			buf = self.buffers[m] = np.empty((batch, frames) + trailing, dtype=dtype)
+			self.masks[m] = np.empty((batch, frames), dtype=bool)
+		return buf, self.masks[m]
+
+	def __call__(self, records):
+		out = {'id': [r['id'] for r in records], 'caption': [r['caption'] for r in records]}
+		if all('caption_id' in r for r in records):
+			# index the encodings of the unique captions, computed once per table
+			out['caption_id'] = np.array([r['caption_id'] for r in records], dtype=np.int64)
+		for m in self.modalities:
+			feats = [r[m] for r in records]
+			lengths = np.array([len(x) for x in feats], dtype=np.int64)
+			flat = np.concatenate(feats)
+			b, frames = len(feats), int(lengths.max())
+			buf, mask = self.buffer(m, b, frames, flat.shape[1:], flat.dtype)
+			buf, mask = buf[:b, :frames], mask[:b, :frames]
+			np.less(np.arange(frames), lengths[:, None], out=mask)
+			buf[...] = 0
+			# True cells of the mask, in row-major order, are the frames of the records in turn
+			buf[mask] = flat
+			out[m], out[f'{m}_mask'], out[f'{m}_length'] = buf, mask, lengths
+		return out
+
+
+def main():
+	""" Report how much padding length-bucketed batches save over random ones. """
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-r', '--records', type=str, default='pickle_files/train_data.pickle',
+		help='a create_pickle.py pickle or shards dir')
+	parser.add_argument('-b', '--batch_size', type=int, default=64)
+	parser.add_argument('-p', '--pool_batches', type=int, default=50,
+		help='batches worth of records sorted together')
+	args = parser.parse_args()
+
+	ids, lengths = load_lengths(args.records)
+	real = lengths.sum(axis=0)
+	shuffled = padded_frames(lengths, random_batches(len(ids), args.batch_size))
+	bucketed = padded_frames(lengths, BucketBatchSampler(lengths, args.batch_size, args.pool_batches))
+	print(f'{len(ids)} records, batches of {args.batch_size}')
+	for j, m in enumerate(MODALITIES):
+		print(f'{m}: {real[j]} frames, padded to {shuffled[j]} random ({shuffled[j] / real[j] - 1:.1%} padding), '
+			f'{bucketed[j]} bucketed ({bucketed[j] / real[j] - 1:.1%}): '
+			f'{1 - bucketed[j] / shuffled[j]:.1%} fewer frames')
+
+
+if __name__ == '__main__':
+	main()
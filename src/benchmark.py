@@ -0,0 +1,205 @@
+import numpy as np
+import os
+import os.path as op
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing as mp
+
+ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+# process groups, each run in a fresh process, and the stages they time; the
+# metadata and pickle stages work in blocks, so their per-item times are averages
+GROUPS = {'metadata': ['metadata'], 'generate': ['render', 'encode', 'tts'],
+	'extract': ['decode', 'wav2vec'], 'pickle': ['pickle', 'shards']}
+
+
+def main():
+	args = get_args()
+	work_dir = args.work_dir or tempfile.mkdtemp(prefix='vatsyn_bench_')
+	os.makedirs(work_dir, exist_ok=True)
+	config = {k: v for k, v in vars(args).items() if k not in ['output', 'compare', 'keep', 'work_dir']}
+
+	stages = dict()
+	ctx = mp.get_context('spawn')
+	for group in args.groups.split(','):
+		with ctx.Pool(1) as pool:
+			timings, rss = pool.apply(run_group, (group, config, work_dir))
+		for stage, t in timings.items():
+			stages[stage] = summarize(t, rss)
+			print(f'{stage:>9}: ' + ', '.join(f'{k} {v}' for k, v in stages[stage].items()))
+
+	results = {'commit': git_commit(), 'time': time.time(), 'config': config,
+		'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+			'cpus': os.cpu_count()}, 'stages': stages}
+	with open(args.output, 'w') as wf:
+		json.dump(results, wf, indent=2)
+	if args.compare: compare(args.compare, results)
+	if not args.keep and not args.work_dir: shutil.rmtree(work_dir)
+
+
+def get_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--num', type=int, default=100, help='clips in the workload')
+	parser.add_argument('-t', '--type', type=str, default='same',
+		choices=['disjoint', 'overlap', 'subset', 'same'])
+	parser.add_argument('--duration', type=float, default=0,
+		help='seconds per clip; 0 keeps the sampled 2-5s durations')
+	parser.add_argument('--encoder', type=str, default='auto', choices=['auto', 'pyav', 'ffmpeg'])
+	parser.add_argument('--preset', type=str, default=None)
+	parser.add_argument('--model', type=str, default='',
+		help='local wav2vec2 dir; empty for a small random model')
+	parser.add_argument('-j', '--threads', type=int, default=1, help='torch threads')
+	parser.add_argument('-g', '--groups', type=str, default=','.join(GROUPS),
+		help=f'comma separated stage groups to run, of {list(GROUPS)}')
+	parser.add_argument('-o', '--output', type=str, default='benchmark.json')
+	parser.add_argument('-c', '--compare', type=str, default='',
+		help='an earlier output to print throughput ratios against')
+	parser.add_argument('--work_dir', type=str, default='',
+		help='where the workload is generated; a temp dir, removed afterwards, by default')
+	parser.add_argument('--keep', action='store_true', help='keep the temp work dir')
+	return parser.parse_args()
+
+
+def run_group(group, config, work_dir):
+	""" Run a stage group; return {stage: per-item seconds} and peak RSS in MB. """
+	sys.path.insert(0, op.join(ROOT, 'feat-extract', 'audio'))
+	timings = globals()[f'bench_{group}'](config, work_dir)
+	return timings, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(times, func, *args):
+	start = time.perf_counter()
+	out = func(*args)
+	times.append(time.perf_counter() - start)
+	return out
+
+
+def bench_metadata(config, work_dir):
+	from metadata import MetadataWriter, sample_block, combos, CHUNK
+	samples = -(-config['num'] // len(combos()))
+	times = []
+	with MetadataWriter(work_dir, config['type'], 42) as writer:
+		for start in range(0, config['num'], CHUNK):
+			stop = min(start + CHUNK, config['num'])
+			block = timed(times, sample_block, 42, start, stop, samples)
+			if config['duration']: block['duration'][:] = config['duration']
+			writer.add_block(block)
+			# spread per-block time over its samples
+			times[-1:] = [times[-1] / (stop - start)] * (stop - start)
+	return {'metadata': times}
+
+
+def bench_generate(config, work_dir):
+	from metadata import load_metadata
+	from renderers import frame_features
+	from encoders import CODEC, FPS, BITRATE
+	from common_functions import accent_to_args
+	import main
+
+	for d in ['video', 'audio', 'features/video']:
+		os.makedirs(op.join(work_dir, d), exist_ok=True)
+	metadata = load_metadata(work_dir)
+	main.init_worker({'type': metadata.type, 'data_path': work_dir, 'renderer': 'numpy',
+		'antialias': True, 'tts': 'tone', 'tts_args': dict(), 'tts_cache': '',
+		'frames_pool': 8, 'frames_dtype': 'uint8', 'encoder': config['encoder'],
+		'encoder_args': {'codec': CODEC, 'preset': config['preset'], 'bitrate': BITRATE, 'fps': FPS},
+		'metrics': False, 'profile': '', 'profile_every': 100})
+	renderer, tts = main.worker['renderer'], main.worker['tts']
+
+	times = {'render': [], 'encode': [], 'tts': []}
+	with open(op.join(work_dir, 'texts.csv'), 'w', newline='') as wf:
+		writer = csv.writer(wf)
+		for i, (id, data) in enumerate(metadata.items()):
+			s = main.gen_shape(id, data)
+			writer.writerow([id, s.gen_sentences()])
+			clip = timed(times['render'], renderer.render_clip, s, data['duration'])
+			timed(times['encode'], renderer.encoder.encode, clip, op.join(work_dir, 'video', f'{id}.mp4'),
+				renderer.width, renderer.height)
+			timed(times['tts'], tts.save, s.audio_sentence, accent_to_args(s.accent),
+				op.join(work_dir, 'audio', f'{id}.mp3'))
+			# pooled frames stand in for video features
+			np.save(op.join(work_dir, 'features/video', f'{id}.npy'), frame_features(clip, 8))
+	return times
+
+
+def bench_extract(config, work_dir):
+	import torch
+	from extract_wav2vec import decode_audio, extract_wav2vec, load_model, tiny_model
+
+	torch.set_num_threads(config['threads'])
+	if config['model']: tokenizer, model = load_model(config['model'])
+	else:
+		# the conv stack of wav2vec2-base, so frame rates are real, with a small transformer
+		tokenizer, model = tiny_model(hidden_size=64, intermediate_size=128,
+			conv_dim=(64,) * 7, conv_stride=(5, 2, 2, 2, 2, 2, 2), conv_kernel=(10, 3, 3, 3, 3, 2, 2),
+			num_conv_pos_embeddings=128, num_conv_pos_embedding_groups=16)
+	out_path = op.join(work_dir, 'features', 'audio')
+	os.makedirs(out_path, exist_ok=True)
+
+	times = {'decode': [], 'wav2vec': []}
+	for f in sorted(os.listdir(op.join(work_dir, 'audio'))):
+		data = timed(times['decode'], decode_audio, op.join(work_dir, 'audio', f))
+		timed(times['wav2vec'], extract_wav2vec, tokenizer, model, data,
+			op.join(out_path, f.replace('.mp3', '.npy')))
+	return times
+
+
+def bench_pickle(config, work_dir):
+	import create_pickle
+	from captions import CaptionTable
+
+	text = dict()
+	with open(op.join(work_dir, 'texts.csv'), newline='') as rf:
+		for row in csv.reader(rf):
+			text[row[0]] = row[1]
+	args = argparse.Namespace(a_path=op.join(work_dir, 'features', 'audio'),
+		v_path=op.join(work_dir, 'features', 'video'), o_path=work_dir, shard_mb=512)
+	ids = list(text)
+	table = CaptionTable.build(text.values())
+	# one timing for the whole split, spread over its records
+	times = dict()
+	for stage, write in [('pickle', create_pickle.write_pickle), ('shards', create_pickle.write_shards)]:
+		start = time.perf_counter()
+		write(args, 'bench', ids, text, table)
+		times[stage] = [(time.perf_counter() - start) / len(ids)] * len(ids)
+	return times
+
+
+def summarize(times, rss):
+	times = np.array(times)
+	return {'items': len(times), 'seconds': round(float(times.sum()), 4),
+		'per_second': round(len(times) / max(float(times.sum()), 1e-9), 2),
+		'p50_ms': round(float(np.percentile(times, 50)) * 1e3, 3) if len(times) else None,
+		'p99_ms': round(float(np.percentile(times, 99)) * 1e3, 3) if len(times) else None,
+		'peak_rss_mb': round(rss, 1)}
+
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+			text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def compare(old_file, new):
+	""" Print new / old throughput and p99 per stage. """
+	with open(old_file) as rf: old = json.load(rf)
+	print(f"vs {old_file} ({(old.get('commit') or '?')[:8]}):")
+	for stage, s in new['stages'].items():
+		if stage not in old['stages']: continue
+		o = old['stages'][stage]
+		line = f"{stage:>9}: throughput x{s['per_second'] / max(o['per_second'], 1e-9):.2f}"
+		if s['p99_ms'] and o['p99_ms']: line += f", p99 x{s['p99_ms'] / o['p99_ms']:.2f}"
+		print(line + f", peak rss {o['peak_rss_mb']} -> {s['peak_rss_mb']} MB")
+
+
+if __name__ == '__main__':
+	main()
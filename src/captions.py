@@ -0,0 +1,73 @@
+import re
+import numpy as np
+
+PAD, UNK = 0, 1
+SPECIALS = ['<pad>', '<unk>']
+
+
+def tokenize(caption):
+	""" Lowercase words and punctuation marks of a caption. """
+	return re.findall(r"[a-z0-9']+|[^\sa-z0-9']", caption.lower())
+
+
+class CaptionTable:
+	""" The unique captions of a dataset, with their token ids precomputed.
+
+	Captions come from a small template space, so records store the caption
+	id k and text encoders run once per unique caption rather than once per
+	record. captions[k] is caption k, and its token ids into vocab are
+	token_ids[offsets[k]:offsets[k + 1]]; ids 0 and 1 are padding and unknown
+	words. Captions are sorted, so a set of captions always gets the same ids.
+	"""
+
+	def __init__(self, captions, vocab, token_ids, offsets):
+		self.captions = list(captions)
+		self.vocab = list(vocab)
+		self.token_ids = np.asarray(token_ids, dtype=np.int32)
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.ids = {c: k for k, c in enumerate(self.captions)}
+		self.words = {w: i for i, w in enumerate(self.vocab)}
+
+	@classmethod
+	def build(cls, captions, vocab=None):
+		""" Table of the unique captions, with a vocab of their words unless given one. """
+		captions = sorted(set(captions))
+		tokens = [tokenize(c) for c in captions]
+		if vocab is None:
+			vocab = SPECIALS + sorted({w for t in tokens for w in t})
+		words = {w: i for i, w in enumerate(vocab)}
+		token_ids = [words.get(w, UNK) for t in tokens for w in t]
+		offsets = np.cumsum([0] + [len(t) for t in tokens])
+		return cls(captions, vocab, token_ids, offsets)
+
+	def __len__(self):
+		return len(self.captions)
+
+	def id(self, caption):
+		return self.ids[caption]
+
+	def tokens(self, k):
+		return self.token_ids[self.offsets[k]:self.offsets[k + 1]]
+
+	def encode(self, caption):
+		""" Token ids of any caption, unknown words included. """
+		if caption in self.ids: return self.tokens(self.ids[caption])
+		return np.array([self.words.get(w, UNK) for w in tokenize(caption)], dtype=np.int32)
+
+	def padded(self, ks=None):
+		""" (len(ks), max tokens) PAD-padded token ids and the lengths of captions ks, all by default. """
+		ks = np.arange(len(self)) if ks is None else np.asarray(ks)
+		lengths = self.offsets[ks + 1] - self.offsets[ks]
+		out = np.full((len(ks), int(lengths.max(initial=0))), PAD, dtype=np.int32)
+		mask = np.arange(out.shape[1]) < lengths[:, None]
+		out[mask] = np.concatenate([self.tokens(k) for k in ks.tolist()] or [out[:0, 0]])
+		return out, lengths
+
+	def save(self, filename):
+		np.savez(filename, caption=np.array(self.captions, dtype=str),
+			vocab=np.array(self.vocab, dtype=str), token_ids=self.token_ids, offsets=self.offsets)
+
+	@classmethod
+	def load(cls, filename):
+		with np.load(filename) as f:
+			return cls(f['caption'].tolist(), f['vocab'].tolist(), f['token_ids'], f['offsets'])
@@ -1,16 +1,18 @@
 import pickle
-import os
 import numpy as np
-import json
 import argparse
 import os.path as op
 import csv
 
-def main():
+from feature_store import ShardWriter
+from batching import lengths_file, write_lengths
+from captions import CaptionTable
+
+def main(argv=None):
 	random_seed = 0
 	np.random.seed(random_seed)
 
-	args = get_args()
+	args = get_args(argv)
 
 	text = dict()
 	with open(args.text_file, newline='') as rf:
@@ -18,30 +20,57 @@ def main():
 		for row in reader:
 			text[row[0]] = row[1]
 
+	# one table for both splits, so a caption has the same id in each
+	table = CaptionTable.build(text.values())
+	table.save(op.join(args.o_path, 'captions.npz'))
+	print(f'{len(text)} captions, {len(table)} unique, {len(table.vocab)} tokens')
+
 	ids = list(text.keys())
 	ids_dict = train_test_split(ids)
-	data_dict = {'train': [], 'test': []}
 
 	for split, ids in ids_dict.items():
-		cnt = 0
-		for id in ids:
-			r = {'id': id, 'caption': text[id]}
-			a_fpath = op.join(args.a_path, id + '.npy')
-			v_fpath = op.join(args.v_path, id + '.npy')
-			if op.exists(a_fpath) and op.exists(v_fpath):
-				r['audio'] = np.load(a_fpath)
-				r['2d'] = np.load(v_fpath)
-				cnt += 1
-				data_dict[split].append(r)
-		print(f'{split}: total: {len(ids)} success: {cnt}')
-
-	for split, data in data_dict.items():
-		pickle_file = op.join(args.o_path, f'{split}_data.pickle') 
-		with open(pickle_file, 'wb') as wf:
-			pickle.dump(data, wf)
-
-
-def get_args():
+		if args.format == 'shards': write_shards(args, split, ids, text, table)
+		else: write_pickle(args, split, ids, text, table)
+
+
+def load_records(args, ids, text, table):
+	""" Yield records of the ids that have both audio and video features.
+
+	Records share the caption strings of table, so a pickle stores each
+	unique caption once.
+	"""
+	for id in ids:
+		k = table.id(text[id])
+		r = {'id': id, 'caption_id': k, 'caption': table.captions[k]}
+		a_fpath = op.join(args.a_path, id + '.npy')
+		v_fpath = op.join(args.v_path, id + '.npy')
+		if op.exists(a_fpath) and op.exists(v_fpath):
+			r['audio'] = np.load(a_fpath)
+			r['2d'] = np.load(v_fpath)
+			yield r
+
+
+def write_pickle(args, split, ids, text, table):
+	data = list(load_records(args, ids, text, table))
+	print(f'{split}: total: {len(ids)} success: {len(data)}')
+
+	pickle_file = op.join(args.o_path, f'{split}_data.pickle') 
+	with open(pickle_file, 'wb') as wf:
+		pickle.dump(data, wf)
+	# frame counts for length-bucketed batching; shards keep theirs in index.npz
+	write_lengths(lengths_file(pickle_file), data)
+
+
+def write_shards(args, split, ids, text, table):
+	cnt = 0
+	with ShardWriter(op.join(args.o_path, split), args.shard_mb << 20, table.captions) as writer:
+		for r in load_records(args, ids, text, table):
+			writer.add(r['id'], r['caption_id'], r)
+			cnt += 1
+	print(f'{split}: total: {len(ids)} success: {cnt}')
+
+
+def get_args(argv=None):
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-t', '--text_file', type=str, default='data/text/texts.csv', 
 		help='text file path')
@@ -51,7 +80,11 @@ def get_args():
 		help='audio features dir path')
 	parser.add_argument('-o', '--o_path', type=str, default='pickle_files/', 
 		help='output pickle files dir path')
-	return parser.parse_args()
+	parser.add_argument('-f', '--format', type=str, default='pickle', choices=['pickle', 'shards'],
+		help='one pickle per split, or memory-mapped .npy shards per split')
+	parser.add_argument('--shard_mb', type=int, default=512,
+		help='target shard size in MB for --format shards')
+	return parser.parse_args(argv)
 
 
 def train_test_split(ids):
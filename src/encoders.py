@@ -0,0 +1,119 @@
+import subprocess
+import argparse
+import time
+import numpy as np
+
+FPS, BITRATE = 10, 1800 # the FFMpegWriter settings of the matplotlib path
+CODEC = 'h264'
+
+
+class FFmpegEncoder:
+	""" One ffmpeg process per clip, fed raw rgb24 frames on stdin. """
+	name = 'ffmpeg'
+
+	def __init__(self, codec=CODEC, preset=None, bitrate=BITRATE, fps=FPS):
+		self.codec, self.preset = codec, preset
+		self.bitrate, self.fps = bitrate, fps
+
+	def encode(self, frames, filename, width, height):
+		cmd = ['ffmpeg', '-f', 'rawvideo', '-vcodec', 'rawvideo', '-s', f'{width}x{height}',
+			'-pix_fmt', 'rgb24', '-r', str(self.fps), '-loglevel', 'error', '-i', 'pipe:',
+			'-vcodec', self.codec, '-pix_fmt', 'yuv420p']
+		if self.preset: cmd += ['-preset', self.preset]
+		if self.bitrate: cmd += ['-b', f'{self.bitrate}k']
+		cmd += ['-f', 'mp4', '-y', filename]
+		proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+		try:
+			for frame in frames:
+				proc.stdin.write(frame.tobytes())
+		finally:
+			_, err = proc.communicate()
+		if proc.returncode != 0:
+			raise RuntimeError(f'ffmpeg failed on {filename}: {err.decode().strip()}')
+
+
+class PyAVEncoder:
+	""" Encode in-process with PyAV, so no process is started per clip.
+
+	Meant to live as long as the worker process that owns it. Needs the av
+	package; the codec names and presets are those of ffmpeg.
+	"""
+	name = 'pyav'
+
+	def __init__(self, codec=CODEC, preset=None, bitrate=BITRATE, fps=FPS):
+		import av
+		self.av = av
+		self.codec, self.preset = codec, preset
+		self.bitrate, self.fps = bitrate, fps
+
+	def encode(self, frames, filename, width, height):
+		av = self.av
+		with av.open(filename, 'w', format='mp4') as container:
+			stream = container.add_stream(self.codec, rate=self.fps)
+			stream.width, stream.height, stream.pix_fmt = width, height, 'yuv420p'
+			if self.bitrate: stream.bit_rate = self.bitrate * 1000
+			if self.preset: stream.options = {'preset': self.preset}
+			for frame in frames:
+				frame = av.VideoFrame.from_ndarray(np.ascontiguousarray(frame), format='rgb24')
+				container.mux(stream.encode(frame))
+			container.mux(stream.encode(None))
+
+
+def get_encoder(name, **kwargs):
+	""" name is ffmpeg, pyav, or auto for pyav if it is installed. """
+	if name == 'auto':
+		try:
+			return PyAVEncoder(**kwargs)
+		except ImportError:
+			return FFmpegEncoder(**kwargs)
+	elif name == 'ffmpeg': return FFmpegEncoder(**kwargs)
+	elif name == 'pyav': return PyAVEncoder(**kwargs)
+	else: raise ValueError(f'unknown encoder: {name}')
+
+
+def throughput(encoder, clips, filename):
+	""" Clips per second and frames per second of encoder over clips. """
+	start = time.time()
+	for clip in clips:
+		encoder.encode(clip, filename, clip.shape[2], clip.shape[1])
+	seconds = time.time() - start
+	return len(clips) / seconds, sum(map(len, clips)) / seconds
+
+
+if __name__ == '__main__':
+	# compare the encoders on clips rendered from random metadata
+	import os
+	import tempfile
+	from renderers import NumpyRenderer
+	from metadata import Metadata, sample_block
+	from common_functions import TYPE
+	from main import gen_shape, worker
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--clips', type=int, default=50)
+	parser.add_argument('--codec', type=str, default=CODEC)
+	parser.add_argument('--preset', type=str, default=None)
+	parser.add_argument('--bitrate', type=int, default=BITRATE)
+	args = parser.parse_args()
+
+	tmp_path = tempfile.mkdtemp()
+	worker.update({'type': TYPE.same, 'data_path': tmp_path})
+	metadata = Metadata(42, 'same', sample_block(42, 0, 4160))
+	renderer = NumpyRenderer()
+	clips = []
+	for i in np.random.default_rng(0).choice(len(metadata), args.clips, replace=False):
+		id, data = str(metadata.ids[i]), metadata.record(i)
+		clips.append(renderer.render_clip(gen_shape(id, data), data['duration']))
+
+	filename = os.path.join(tmp_path, 'clip.mp4')
+	for name in ['ffmpeg', 'pyav']:
+		try:
+			encoder = get_encoder(name, codec=args.codec, preset=args.preset, bitrate=args.bitrate)
+		except ImportError as e:
+			print(f'{name}: not available ({e})')
+			continue
+		clips_s, frames_s = throughput(encoder, clips, filename)
+		print(f'{name}: {clips_s:.1f} clips/s, {frames_s:.0f} frames/s, '
+			f'{os.path.getsize(filename) / 1024:.1f} KiB last clip')
+	os.remove(filename)
+	os.rmdir(tmp_path)
@@ -0,0 +1,140 @@
+import numpy as np
+import os.path as op
+import argparse
+import pickle
+import json
+
+from metadata import load_metadata, FIELDS
+
+VISUAL = ['shape', 'fgcolor', 'bgcolor', 'action', 'speed', 'dir']
+# the metadata attributes that each modality's sentence describes, per dataset type
+DESCRIBES = {
+	'disjoint': {'text': ['shape', 'fgcolor', 'bgcolor'], 'audio': ['action', 'speed', 'dir']},
+	'overlap': {'text': ['shape', 'fgcolor', 'bgcolor'], 'audio': ['shape', 'action', 'speed', 'dir']},
+	'subset': {'text': ['shape', 'fgcolor', 'bgcolor'], 'audio': VISUAL},
+	'same': {'text': VISUAL, 'audio': VISUAL}}
+MODALITIES = ['audio', 'video', 'text']
+KS = (1, 5, 10)
+
+
+def main():
+	args = get_args()
+	ids = record_ids(args.records)
+	embeddings = load_embeddings(args.embeddings, ids)
+	metadata = load_metadata(args.data_path) if args.relevance == 'attributes' else None
+
+	results = dict()
+	for query in MODALITIES:
+		for gallery in MODALITIES:
+			if query == gallery or query not in embeddings or gallery not in embeddings: continue
+			if metadata is None:
+				keys = np.arange(len(ids))
+				qkeys, gkeys = keys, keys
+			else:
+				shared = shared_attributes(metadata.type, query, gallery)
+				if not shared:
+					print(f'{query} -> {gallery}: skipped, the modalities share no attributes')
+					continue
+				qkeys = gkeys = relevance_keys(metadata, ids, shared)
+			r = retrieval_metrics(embeddings[query], embeddings[gallery], qkeys, gkeys,
+				args.block_mb << 20, not args.no_map)
+			results[f'{query}->{gallery}'] = r
+			print(f'{query} -> {gallery}: ' + ', '.join(f'{k} {v:.4f}' for k, v in r.items()))
+
+	if args.output:
+		with open(args.output, 'w') as wf:
+			json.dump(results, wf, indent=2)
+
+
+def get_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-r', '--records', type=str, default='pickle_files/test_data.pickle',
+		help='test split of create_pickle.py: a pickle, or a shards dir')
+	parser.add_argument('-e', '--embeddings', type=str, default='embeddings/test.npz',
+		help='npz of an id array and (N, dim) audio, video and/or text embeddings')
+	parser.add_argument('-d', '--data_path', type=str, default='./data/',
+		help='dataset dir with the metadata, for attribute relevance')
+	parser.add_argument('--relevance', type=str, default='attributes', choices=['attributes', 'id'],
+		help='relevant items share the attributes both modalities describe, or only the same id')
+	parser.add_argument('--block_mb', type=int, default=256,
+		help='memory for a block of rows of the similarity matrix')
+	parser.add_argument('--no_map', action='store_true',
+		help='skip mAP, which needs every row sorted')
+	parser.add_argument('-o', '--output', type=str, default='',
+		help='also write the metrics to this json file')
+	return parser.parse_args()
+
+
+def record_ids(records):
+	""" Ids of the records of a create_pickle.py pickle or shards dir. """
+	if op.isdir(records):
+		from feature_store import FeatureStore
+		return [str(id) for id in FeatureStore(records).ids.tolist()]
+	with open(records, 'rb') as rf:
+		return [str(r['id']) for r in pickle.load(rf)]
+
+
+def load_embeddings(embeddings_file, ids):
+	""" Unit-norm float32 embeddings per modality, in the order of ids. """
+	with np.load(embeddings_file) as f:
+		position = {str(id): i for i, id in enumerate(f['id'].tolist())}
+		missing = [id for id in ids if id not in position]
+		if missing: raise KeyError(f'{len(missing)} ids have no embeddings, e.g. {missing[0]}')
+		rows = np.array([position[id] for id in ids], dtype=np.int64)
+		out = dict()
+		for m in MODALITIES:
+			if m not in f.files: continue
+			x = f[m][rows].astype(np.float32)
+			out[m] = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+	return out
+
+
+def shared_attributes(type, query, gallery):
+	describes = dict(DESCRIBES[type], video=VISUAL)
+	return [a for a in describes[query] if a in describes[gallery]]
+
+
+def relevance_keys(metadata, ids, attributes):
+	""" One int64 per id, equal for ids that agree on all of attributes. """
+	order = np.argsort(metadata.ids)
+	rows = order[np.searchsorted(metadata.ids, np.array(ids, dtype=np.int64), sorter=order)]
+	keys = np.zeros(len(ids), dtype=np.int64)
+	for a in attributes:
+		keys = keys * (len(FIELDS[a]) + 1) + metadata[a][rows]
+	return keys
+
+
+def retrieval_metrics(queries, gallery, qkeys, gkeys, block_bytes=256 << 20, ap=True, ks=KS):
+	""" R@k, median rank and mAP of retrieving gallery items with queries.
+
+	queries (N, dim) and gallery (M, dim) are unit-norm, so similarity is
+	cosine. Gallery item j is relevant to query i if gkeys[j] == qkeys[i]. The
+	rank of a query is that of its best-ranked relevant item. Only a block of
+	rows of the N x M similarity matrix is held at a time.
+	"""
+	n, m = len(queries), len(gallery)
+	block = max(1, block_bytes // (m * 4 * 3))
+	ranks = np.empty(n, dtype=np.int64)
+	aps = np.empty(n)
+	for start in range(0, n, block):
+		s = queries[start:start + block] @ gallery.T
+		relevant = qkeys[start:start + block, None] == gkeys[None]
+		best = np.where(relevant, s, -np.inf).max(axis=1)
+		ranks[start:start + block] = 1 + (s > best[:, None]).sum(axis=1)
+		if not ap: continue
+
+		# the rank of every relevant item is one plus the number of items above it
+		ordered = np.sort(s, axis=1)
+		for i in range(len(s)):
+			hits = np.sort(s[i, relevant[i]])[::-1]
+			above = m - np.searchsorted(ordered[i], hits, side='right')
+			aps[start + i] = np.mean(np.arange(1, len(hits) + 1) / (above + 1))
+
+	out = {f'R@{k}': float(np.mean(ranks <= k)) for k in ks}
+	out['median_rank'] = float(np.median(ranks))
+	if ap: out['mAP'] = float(aps.mean())
+	return out
+
+
+if __name__ == '__main__':
+	main()
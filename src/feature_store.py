@@ -0,0 +1,250 @@
+import numpy as np
+import os
+import os.path as op
+import csv
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from captions import CaptionTable
+
+MODALITIES = ['audio', '2d']
+
+
+class ShardWriter:
+	""" Stream per-id features into large contiguous .npy shards.
+
+	Each modality is written to its own shards ({modality}_000.npy, ...), which
+	are the features of consecutive ids concatenated along the first axis.
+	index.npz holds the ids, caption ids and a (shard, offset, length) triple
+	per id and modality, and the unique captions the caption ids point into.
+	At most one shard per modality is held in memory.
+	"""
+
+	def __init__(self, path, shard_bytes=512 << 20, captions=()):
+		os.makedirs(path, exist_ok=True)
+		self.path = path
+		self.shard_bytes = shard_bytes
+		self.captions = list(captions)
+		self.ids, self.caption_ids = [], []
+		self.index = {m: [] for m in MODALITIES}
+		self.buffers = {m: [] for m in MODALITIES}
+		self.nbytes = {m: 0 for m in MODALITIES}
+		self.shard = {m: 0 for m in MODALITIES}
+		self.offset = {m: 0 for m in MODALITIES}
+		self.layout = dict() # modality -> (dtype, trailing shape)
+
+	def add(self, id, caption_id, feats):
+		""" Append one record; caption_id indexes captions, feats maps each modality to an array. """
+		for m in MODALITIES:
+			x = np.asarray(feats[m])
+			layout = (x.dtype, x.shape[1:])
+			if self.layout.setdefault(m, layout) != layout:
+				raise ValueError(f'{id} {m} has layout {layout}, store has {self.layout[m]}')
+			self.index[m].append((self.shard[m], self.offset[m], x.shape[0]))
+			self.buffers[m].append(x)
+			self.offset[m] += x.shape[0]
+			self.nbytes[m] += x.nbytes
+			if self.nbytes[m] >= self.shard_bytes:
+				self.flush(m)
+
+		self.ids.append(str(id))
+		self.caption_ids.append(caption_id)
+
+	def flush(self, m):
+		if not self.buffers[m]: return
+		dtype, trailing = self.layout[m]
+		fname = op.join(self.path, f'{m}_{self.shard[m]:03d}.npy')
+		out = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+			shape=(self.offset[m],) + trailing)
+		start = 0
+		for x in self.buffers[m]:
+			out[start:start + x.shape[0]] = x
+			start += x.shape[0]
+		out.flush()
+		del out
+
+		self.buffers[m], self.nbytes[m], self.offset[m] = [], 0, 0
+		self.shard[m] += 1
+
+	def close(self):
+		for m in MODALITIES: self.flush(m)
+
+		arrays = {'id': np.array(self.ids, dtype=str),
+			'caption_id': np.array(self.caption_ids, dtype=np.int32),
+			'captions': np.array(self.captions, dtype=str)}
+		for m in MODALITIES:
+			index = np.array(self.index[m], dtype=np.int64).reshape(-1, 3)
+			arrays[f'{m}_shard'] = index[:, 0].astype(np.int32)
+			arrays[f'{m}_offset'] = index[:, 1]
+			arrays[f'{m}_length'] = index[:, 2]
+		np.savez(op.join(self.path, 'index.npz'), **arrays)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class FeatureStore:
+	""" Read records of a ShardWriter store as zero-copy memmap slices.
+
+	store[i] returns {'id', 'caption_id', 'caption', 'audio', '2d'} like the
+	pickle records; captions holds the unique captions. Shards are opened on
+	first use, so startup only reads index.npz.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with np.load(op.join(path, 'index.npz')) as index:
+			self.ids = index['id']
+			self.captions, self.caption_ids = index['captions'].tolist(), index['caption_id']
+			self.index = {m: (index[f'{m}_shard'], index[f'{m}_offset'], index[f'{m}_length'])
+				for m in MODALITIES}
+		self.shards = dict()
+		self.positions = None
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __getitem__(self, i):
+		k = int(self.caption_ids[i])
+		r = {'id': str(self.ids[i]), 'caption_id': k, 'caption': self.captions[k]}
+		for m in MODALITIES:
+			r[m] = self.feature(m, i)
+		return r
+
+	def get(self, id):
+		""" Record by id rather than position. """
+		if self.positions is None:
+			self.positions = {id: i for i, id in enumerate(self.ids.tolist())}
+		return self[self.positions[str(id)]]
+
+	def load(self, i):
+		""" Record i with its features read into memory. """
+		r = self[i]
+		for m in MODALITIES:
+			r[m] = np.array(r[m])
+		return r
+
+	def feature(self, m, i):
+		shards, offsets, lengths = self.index[m]
+		shard, offset = int(shards[i]), int(offsets[i])
+		return self.open(m, shard)[offset:offset + int(lengths[i])]
+
+	def open(self, m, shard):
+		if (m, shard) not in self.shards:
+			fname = op.join(self.path, f'{m}_{shard:03d}.npy')
+			self.shards[(m, shard)] = np.load(fname, mmap_mode='r')
+		return self.shards[(m, shard)]
+
+
+class FeatureFiles:
+	""" Records backed by the per-id features/audio and features/video .npy files.
+
+	Only ids of text_file (optionally restricted to ids) that have both
+	features are kept, and caption ids index the CaptionTable of text_file,
+	as in create_pickle.py.
+	"""
+
+	def __init__(self, text_file, a_path, v_path, ids=None):
+		self.a_path, self.v_path = a_path, v_path
+		text = dict()
+		with open(text_file, newline='') as rf:
+			for row in csv.reader(rf):
+				if row: text[row[0]] = row[1]
+		if ids is None: ids = list(text.keys())
+		self.table = CaptionTable.build(text.values())
+		self.captions = self.table.captions
+
+		self.ids, self.caption_ids = [], []
+		for id in ids:
+			if op.exists(self.fpath(self.a_path, id)) and op.exists(self.fpath(self.v_path, id)):
+				self.ids.append(id)
+				self.caption_ids.append(self.table.id(text[id]))
+
+	def __len__(self):
+		return len(self.ids)
+
+	def fpath(self, path, id):
+		return op.join(path, f'{id}.npy')
+
+	def load(self, i):
+		id = self.ids[i]
+		k = self.caption_ids[i]
+		return {'id': id, 'caption_id': k, 'caption': self.captions[k],
+			'audio': np.load(self.fpath(self.a_path, id)),
+			'2d': np.load(self.fpath(self.v_path, id))}
+
+
+class LazyDataset:
+	""" Random access to records of a FeatureFiles or FeatureStore source.
+
+	Records are loaded on demand and kept in an LRU cache bounded by
+	cache_bytes of feature data. Every access also reads ahead the next
+	read_ahead records of the expected order on background threads. The order
+	is sequential unless set_order is given the shuffled order of an epoch.
+	"""
+
+	def __init__(self, source, cache_bytes=1 << 30, read_ahead=32, workers=4):
+		self.source = source
+		self.cache_bytes = cache_bytes
+		self.read_ahead = read_ahead
+		self.cache = OrderedDict()
+		self.nbytes = 0
+		self.pending = dict()
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(workers) if read_ahead > 0 else None
+		self.set_order(None)
+
+	def __len__(self):
+		return len(self.source)
+
+	def set_order(self, order):
+		""" Expected access order (a permutation of indices), None for sequential. """
+		n = len(self)
+		self.order = np.arange(n) if order is None else np.asarray(order)
+		self.position = np.empty(n, dtype=np.int64)
+		self.position[self.order] = np.arange(len(self.order))
+
+	def __getitem__(self, i):
+		if i < 0: i += len(self)
+		with self.lock:
+			r = self.cache.get(i)
+			if r is not None: self.cache.move_to_end(i)
+			future = self.pending.get(i)
+		if r is None:
+			r = future.result() if future is not None else self.fetch(i)
+		self.prefetch(i)
+		return r
+
+	def prefetch(self, i):
+		if self.executor is None: return
+		p = self.position[i]
+		with self.lock:
+			for j in self.order[p + 1:p + 1 + self.read_ahead].tolist():
+				if j not in self.cache and j not in self.pending:
+					self.pending[j] = self.executor.submit(self.fetch, j)
+
+	def fetch(self, i):
+		""" Load record i into the cache, evicting least recently used records. """
+		try:
+			r = self.source.load(i)
+		except Exception:
+			with self.lock: self.pending.pop(i, None)
+			raise
+
+		size = sum(r[m].nbytes for m in MODALITIES)
+		with self.lock:
+			self.pending.pop(i, None)
+			if i not in self.cache and size <= self.cache_bytes:
+				self.cache[i] = r
+				self.nbytes += size
+				while self.nbytes > self.cache_bytes:
+					_, old = self.cache.popitem(last=False)
+					self.nbytes -= sum(old[m].nbytes for m in MODALITIES)
+		return r
+
+	def close(self):
+		if self.executor is not None: self.executor.shutdown(cancel_futures=True)
@@ -2,20 +2,51 @@ import os
 import argparse
 import json
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-d', '--data_path', type=str, default='./data/')
-args = parser.parse_args()
-
-metadata_file = os.path.join(args.data_path, 'metadata.json')
-with open(metadata_file, 'r') as rf:
-	metadata = json.load(rf)
-
-failed_ids = []
-for id in metadata['content']:
-	f = os.path.join(args.data_path, 'audio', f'{id}.mp3')
-	if not os.path.isfile(f):
-		failed_ids.append(id)
-
-failed_ids_file = os.path.join(args.data_path, 'failed_ids.json')
-with open(failed_ids_file, 'w') as wf:
-	json.dump(failed_ids, wf, indent=2)
\ No newline at end of file
+from core import metadata_ids
+from jobs import JobDB, STAGES, STAGE_FILES, DEFAULT_STAGES, shard_job_files
+
+
+def main(argv=None):
+	args = get_args(argv)
+	# only the ids are needed, and reading them without numpy keeps this quick
+	ids = metadata_ids(args.data_path)
+
+	# a sharded run records its jobs in a table per shard, and any of them may have done an id
+	db_files = shard_job_files(args.data_path)
+	if os.path.isfile(os.path.join(args.data_path, 'jobs.sqlite')):
+		db_files.append(os.path.join(args.data_path, 'jobs.sqlite'))
+	if db_files:
+		dbs = [JobDB(args.data_path, db_file=f) for f in db_files]
+		if args.stage == 'all':
+			# the stages of the run's --outputs, rather than video and audio
+			recorded = {s for db in dbs for s in db.saved_stages()}
+			stages = [s for s in STAGES if s in recorded] or DEFAULT_STAGES
+		else: stages = [args.stage]
+		done = set.intersection(*[set.union(*[db.done_ids(stage) for db in dbs]) for stage in stages])
+		for db in dbs: db.close()
+		failed_ids = [id for id in ids if id not in done]
+	else:
+		# datasets generated before the job table existed
+		stages = DEFAULT_STAGES if args.stage == 'all' else [args.stage]
+		failed_ids = []
+		for id in ids:
+			files = [os.path.join(args.data_path, STAGE_FILES[s][0], f'{id}.{STAGE_FILES[s][1]}')
+				for s in stages]
+			if not all(os.path.isfile(f) for f in files):
+				failed_ids.append(id)
+
+	failed_ids_file = os.path.join(args.data_path, 'failed_ids.json')
+	with open(failed_ids_file, 'w') as wf:
+		json.dump(failed_ids, wf, indent=2)
+
+
+def get_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-d', '--data_path', type=str, default='./data/')
+	parser.add_argument('-s', '--stage', type=str, default='audio', choices=STAGES + ['all'],
+		help='report ids whose stage is not done; all means any stage of the run\'s --outputs')
+	return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,58 +1,67 @@
 import numpy as np
-from numpy.random import uniform
-from itertools import product
-import json
+from numpy.random import uniform, choice
 import argparse
+import os
 import os.path as op
 
-from common_functions import *
-from shapes_classes import *
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-d', '--data_path', type=str, default='./data/')
-parser.add_argument('-t', '--metadata_type', type=str, default='disjoint',
-					choices=['disjoint', 'overlap', 'subset', 'same'])
-args = parser.parse_args()
+from core import *
+from metadata import *
 
 random_seed = 42
-np.random.seed(random_seed)
-START_ID = int(1e5)
-DURATION_SMALL, DURATION_BIG = 2.0, 5.0
-
-metadata = dict()
-metadata['seed'] = random_seed
-metadata['type'] = args.metadata_type
-metadata['content'] = dict()
-
-cnt = 0
-for shape, fgcolor, bgcolor, speed in product(SHAPE, FGCOLOR, BGCOLOR, SPEED):		
-	if shape == SHAPE.circle:
-		actions = [ACTION.shift, ACTION.grow, ACTION.jump]
+
+
+def main(argv=None):
+	args = get_args(argv)
+	os.makedirs(args.data_path, exist_ok=True)
+
+	# metadata of another format would shadow or be shadowed by the new one
+	for name in FORMATS.values():
+		for f in [op.join(args.data_path, name), cache_file(op.join(args.data_path, name))]:
+			if op.isfile(f): os.remove(f)
+	writer = MetadataWriter(args.data_path, args.metadata_type, random_seed, args.format)
+
+	if args.rng == 'counter':
+		total = len(combos()) * args.samples
+		for start in range(0, total, CHUNK):
+			writer.add_block(sample_block(random_seed, start, min(start + CHUNK, total), args.samples))
 	else:
-		actions = [ACTION.rotate, ACTION.shift, ACTION.grow, ACTION.jump]
-
-	for action in actions:
-		if action == ACTION.shift: dirs = [DIR.right, DIR.left, DIR.up, DIR.down]		
-		elif action == ACTION.rotate: dirs = [DIR.clock, DIR.anticlock]
-		elif action == ACTION.grow: dirs = [DIR.bigger, DIR.smaller]
-		elif action == ACTION.jump: dirs = [DIR.up]
-		else: perror('gen metadata triangle invalid action')
-
-		for dir in dirs: 
-			if shape in regular_polygons:
-				points = regular_polygon_sampler()
-			elif shape in circular_shapes:
-				points = ellipse_sampler(shape == SHAPE.circle)
-			else: perror(f'gen metadata invalid shape: {shape}')
-
-			duration = uniform(DURATION_SMALL, DURATION_BIG)
-			accent = choice(ACCENT) # for TTS
-			d = {'shape': shape.name, 'points': points, 'fgcolor': fgcolor.name,
-				'bgcolor': bgcolor.name, 'action': action.name, 'speed': speed.name,
-				'dir': dir.name, 'duration': duration, 'accent': accent.name}
-
-			metadata['content'][START_ID + cnt] = d
-			cnt += 1
-
-with open(op.join(args.data_path, f'metadata.json'), 'w') as wf:
-	json.dump(metadata, wf, indent=2)
+		# every draw depends on all the draws before it
+		np.random.seed(random_seed)
+		cnt = 0
+		for shape, fgcolor, bgcolor, speed, action, dir in combos():
+			for _ in range(args.samples):
+				if shape in regular_polygons:
+					points = regular_polygon_sampler()
+				elif shape in circular_shapes:
+					points = ellipse_sampler(shape == SHAPE.circle)
+				else: perror(f'gen metadata invalid shape: {shape}')
+
+				duration = uniform(DURATION_SMALL, DURATION_BIG)
+				accent = choice(ACCENT) # for TTS
+				d = {'shape': shape.name, 'points': points, 'fgcolor': fgcolor.name,
+					'bgcolor': bgcolor.name, 'action': action.name, 'speed': speed.name,
+					'dir': dir.name, 'duration': duration, 'accent': accent.name}
+
+				writer.add(START_ID + cnt, d)
+				cnt += 1
+
+	writer.close()
+
+
+def get_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-d', '--data_path', type=str, default='./data/')
+	parser.add_argument('-t', '--metadata_type', type=str, default='disjoint',
+						choices=['disjoint', 'overlap', 'subset', 'same'])
+	parser.add_argument('-f', '--format', type=str, default='npz', choices=list(FORMATS),
+						help='npz columns, jsonl records, or the original indented json')
+	parser.add_argument('-n', '--samples', type=int, default=1,
+						help='samples per (shape, fgcolor, bgcolor, speed, action, dir)')
+	parser.add_argument('--rng', type=str, default='counter', choices=['counter', 'legacy'],
+						help='per-sample Philox streams drawn in blocks, or the original '
+						'sequential global np.random draws')
+	return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,191 @@
+import os
+import os.path as op
+import json
+import time
+import threading
+from array import array
+from contextlib import contextmanager, nullcontext
+from collections import Counter
+
+NULL = nullcontext()
+
+
+class Timer:
+	""" Observes the seconds spent in a with block, less any excluded ones. """
+	__slots__ = ('metrics', 'stage', 'id', 'start', 'excluded')
+
+	def __init__(self, metrics, stage, id):
+		self.metrics, self.stage, self.id = metrics, stage, id
+		self.excluded = 0.
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.metrics.observe(self.stage, time.perf_counter() - self.start - self.excluded, self.id)
+
+
+class Metrics:
+	""" Per-stage timers and counters of one process, off unless configured.
+
+	Worker processes buffer events and counters, and drain() them into the
+	results they send back; the parent merge()s them and flush()es to the
+	sink: a JSONL file of events, or a Prometheus textfile (*.prom) of
+	totals and quantiles, rewritten on every flush. When disabled, timer()
+	returns a shared null context and the other calls return at once.
+	"""
+
+	def __init__(self):
+		self.enabled = False
+		self.sink = None
+		self.profile, self.profile_every, self.profile_path = None, 0, None
+		self.events, self.counters = [], Counter()
+		self.stats = dict() # stage -> array of seconds, in the process that flushes
+		self.totals = Counter()
+		self.samples = 0
+		self.lock = threading.Lock()
+
+	def configure(self, sink=None, profile=None, profile_every=100, profile_path='profiles'):
+		self.enabled = True
+		self.sink = sink
+		self.profile, self.profile_every, self.profile_path = profile, profile_every, profile_path
+		if sink and not sink.endswith('.prom') and op.isfile(sink): os.remove(sink)
+
+	def timer(self, stage, id=None):
+		return Timer(self, stage, id) if self.enabled else NULL
+
+	def observe(self, stage, seconds, id=None):
+		if not self.enabled: return
+		with self.lock: self.events.append((time.time(), id, stage, seconds))
+
+	def count(self, name, n=1):
+		if not self.enabled: return
+		with self.lock: self.counters[name] += n
+
+	def timed_iter(self, stage, iterable, id=None, within=None):
+		""" Iterate over iterable, observing the total time spent producing the items.
+
+		That time is excluded from the within timer, so that a consumer timed
+		around a generator it pulls from gets only its own share.
+		"""
+		if not self.enabled: return iterable
+		return self._timed_iter(stage, iterable, id, within)
+
+	def _timed_iter(self, stage, iterable, id, within):
+		seconds, it = 0., iter(iterable)
+		try:
+			while True:
+				start = time.perf_counter()
+				try:
+					item = next(it)
+				except StopIteration:
+					break
+				seconds += time.perf_counter() - start
+				yield item
+		finally:
+			self.observe(stage, seconds, id)
+			if within is not None: within.excluded += seconds
+
+	@contextmanager
+	def profiled(self, name):
+		""" Profile one in profile_every calls with cProfile or tracemalloc. """
+		self.samples += 1
+		if not self.enabled or not self.profile or (self.samples - 1) % self.profile_every:
+			yield
+			return
+		os.makedirs(self.profile_path, exist_ok=True)
+		prefix = op.join(self.profile_path, f'{os.getpid()}_{name}')
+		if self.profile == 'cprofile':
+			import cProfile
+			profiler = cProfile.Profile()
+			profiler.enable()
+			try:
+				yield
+			finally:
+				profiler.disable()
+				profiler.dump_stats(prefix + '.prof')
+		else:
+			import tracemalloc
+			tracemalloc.start()
+			try:
+				yield
+			finally:
+				snapshot = tracemalloc.take_snapshot()
+				peak = tracemalloc.get_traced_memory()[1]
+				tracemalloc.stop()
+				with open(prefix + '.txt', 'w') as wf:
+					wf.write(f'peak traced memory: {peak / 2**20:.1f} MiB\n')
+					for stat in snapshot.statistics('lineno')[:25]:
+						wf.write(f'{stat}\n')
+
+	def drain(self):
+		""" Take the buffered events and counters, to send to the parent. """
+		if not self.enabled: return None
+		with self.lock:
+			out = (self.events, dict(self.counters))
+			self.events, self.counters = [], Counter()
+		return out
+
+	def merge(self, drained):
+		if drained is None: return
+		events, counters = drained
+		with self.lock:
+			self.events += events
+			self.counters.update(counters)
+
+	def flush(self):
+		""" Fold buffered events into the stats and write them to the sink. """
+		if not self.enabled: return
+		with self.lock:
+			events, self.events = self.events, []
+			self.totals.update(self.counters)
+			self.counters = Counter()
+		for _, _, stage, seconds in events:
+			self.stats.setdefault(stage, array('d')).append(seconds)
+		if not self.sink: return
+		if self.sink.endswith('.prom'): self.write_prometheus()
+		else:
+			with open(self.sink, 'a') as wf:
+				for t, id, stage, seconds in events:
+					wf.write(json.dumps({'time': t, 'id': id, 'stage': stage, 'seconds': seconds}) + '\n')
+
+	def summary(self):
+		""" {stage: count, total, mean, p50, p99 seconds}, plus the counters. """
+		import numpy as np
+		out = dict()
+		for stage, seconds in self.stats.items():
+			x = np.frombuffer(seconds, dtype=np.float64)
+			out[stage] = {'count': len(x), 'total': float(x.sum()), 'mean': float(x.mean()),
+				'p50': float(np.percentile(x, 50)), 'p99': float(np.percentile(x, 99))}
+		return {'stages': out, 'counters': dict(self.totals)}
+
+	def write_prometheus(self):
+		summary = self.summary()
+		lines = ['# TYPE vatsyn_stage_seconds summary']
+		for stage, s in summary['stages'].items():
+			for q in ['p50', 'p99']:
+				lines.append(f'vatsyn_stage_seconds{{stage="{stage}",quantile="0.{q[1:]}"}} {s[q]}')
+			lines.append(f'vatsyn_stage_seconds_sum{{stage="{stage}"}} {s["total"]}')
+			lines.append(f'vatsyn_stage_seconds_count{{stage="{stage}"}} {s["count"]}')
+		lines.append('# TYPE vatsyn_events_total counter')
+		for name, n in summary['counters'].items():
+			lines.append(f'vatsyn_events_total{{name="{name}"}} {n}')
+		tmp_file = self.sink + '.tmp'
+		with open(tmp_file, 'w') as wf: wf.write('\n'.join(lines) + '\n')
+		os.replace(tmp_file, self.sink)
+
+	def print_summary(self):
+		if not self.enabled: return
+		self.flush()
+		summary = self.summary()
+		print(f'{"stage":>10} {"count":>8} {"total s":>9} {"mean ms":>9} {"p50 ms":>9} {"p99 ms":>9}')
+		for stage, s in summary['stages'].items():
+			print(f'{stage:>10} {s["count"]:>8} {s["total"]:>9.1f} {s["mean"] * 1e3:>9.2f} '
+				f'{s["p50"] * 1e3:>9.2f} {s["p99"] * 1e3:>9.2f}')
+		for name, n in summary['counters'].items():
+			print(f'{name}: {n}')
+
+
+# the metrics of this process
+metrics = Metrics()
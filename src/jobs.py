@@ -0,0 +1,145 @@
+import os
+import os.path as op
+import time
+import json
+import sqlite3
+import hashlib
+
+# stage -> (output dir, file extension)
+STAGE_FILES = {'video': ('video', 'mp4'), 'audio': ('audio', 'mp3'), 'frames': ('frames', 'npy')}
+STAGES = list(STAGE_FILES)
+DEFAULT_STAGES = ['video', 'audio']
+
+
+def checksum(filename):
+	h = hashlib.sha1()
+	with open(filename, 'rb') as rf:
+		for block in iter(lambda: rf.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def shard_job_files(data_path):
+	""" The jobs_{shard}.sqlite tables of a sharded run, see shards.Shards. """
+	path = op.join(data_path, 'shards')
+	if not op.isdir(path): return []
+	return [op.join(path, name) for name in sorted(os.listdir(path))
+		if name.startswith('jobs_') and name.endswith('.sqlite')]
+
+
+def run_stage(func, filename, tmp_path, *args):
+	""" Call func(tmp_file, *args), then move tmp_file to filename.
+
+	Returns the job row fields of the stage. Outputs only appear under their
+	final name once complete, so a killed run never leaves a truncated file.
+	"""
+	os.makedirs(tmp_path, exist_ok=True)
+	tmp_file = op.join(tmp_path, f'{os.uname().nodename}_{os.getpid()}_{op.basename(filename)}')
+	start = time.time()
+	try:
+		if func(tmp_file, *args) is False:
+			raise RuntimeError(f'{func.__name__} failed')
+		os.replace(tmp_file, filename)
+		return {'status': 'done', 'size': op.getsize(filename),
+			'checksum': checksum(filename), 'seconds': time.time() - start, 'error': None}
+	except Exception as e:
+		print(e)
+		if op.isfile(tmp_file): os.remove(tmp_file)
+		return {'status': 'failed', 'size': None, 'checksum': None,
+			'seconds': time.time() - start, 'error': str(e)}
+
+
+class JobDB:
+	""" Per-dataset job table: status of every (id, stage), plus captions.
+
+	Lives in {data_path}/jobs.sqlite, or db_file. Only the parent process
+	writes to it. An id is complete once all of stages are done.
+	"""
+
+	def __init__(self, data_path, stages=DEFAULT_STAGES, db_file=None):
+		self.data_path = data_path
+		self.stages = stages
+		self.conn = sqlite3.connect(db_file or op.join(data_path, 'jobs.sqlite'))
+		self.conn.executescript('''
+			CREATE TABLE IF NOT EXISTS jobs (
+				id TEXT, stage TEXT, status TEXT, size INTEGER, checksum TEXT,
+				seconds REAL, error TEXT, updated REAL, PRIMARY KEY (id, stage));
+			CREATE TABLE IF NOT EXISTS captions (id TEXT PRIMARY KEY, caption TEXT);
+			CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+		''')
+
+	def output_file(self, id, stage):
+		dir, ext = STAGE_FILES[stage]
+		return op.join(self.data_path, dir, f'{id}.{ext}')
+
+	def pending(self, ids):
+		""" Map each id to the stages it still needs.
+
+		A stage counts as done only if its output still exists with the
+		recorded size.
+		"""
+		ids = list(ids)
+		query = "SELECT id, stage, size FROM jobs WHERE status = 'done'"
+		if len(ids) <= 500:
+			# a batch of ids is looked up by key rather than reading the whole table
+			query += f" AND id IN ({', '.join('?' * len(ids))})"
+			rows = self.conn.execute(query, ids)
+		else: rows = self.conn.execute(query)
+		done = dict()
+		for id, stage, size in rows:
+			done[(id, stage)] = size
+
+		todo = dict()
+		for id in ids:
+			stages = []
+			for stage in self.stages:
+				size = done.get((id, stage))
+				f = self.output_file(id, stage)
+				if size is None or not op.isfile(f) or op.getsize(f) != size:
+					stages.append(stage)
+			todo[id] = stages
+		return todo
+
+	def record(self, id, stage, result):
+		self.conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+			(id, stage, result['status'], result['size'], result['checksum'],
+			result['seconds'], result['error'], time.time()))
+
+	def invalidate(self, id, stage, error):
+		""" Mark a stage not done, so that pending() hands it out again. """
+		self.record(id, stage, {'status': 'invalid', 'size': None, 'checksum': None,
+			'seconds': None, 'error': error})
+
+	def save_stages(self):
+		""" Record the stages of the run, which --outputs decides, for later tools. """
+		self.conn.execute("INSERT OR REPLACE INTO settings VALUES ('stages', ?)", (json.dumps(self.stages),))
+
+	def saved_stages(self):
+		""" Stages recorded by save_stages, or those with job rows in older tables. """
+		row = self.conn.execute("SELECT value FROM settings WHERE key = 'stages'").fetchone()
+		if row is not None: return json.loads(row[0])
+		present = {row[0] for row in self.conn.execute('SELECT DISTINCT stage FROM jobs')}
+		return [s for s in STAGES if s in present]
+
+	def set_caption(self, id, caption):
+		self.conn.execute('INSERT OR REPLACE INTO captions VALUES (?, ?)', (id, caption))
+
+	def commit(self):
+		self.conn.commit()
+
+	def captions(self):
+		""" Captions of the ids whose every stage is done. """
+		marks = ', '.join('?' * len(self.stages))
+		rows = self.conn.execute(f'''
+			SELECT c.id, c.caption FROM captions c JOIN jobs j ON c.id = j.id
+			WHERE j.status = 'done' AND j.stage IN ({marks})
+			GROUP BY c.id HAVING COUNT(*) = ?''', (*self.stages, len(self.stages)))
+		return dict(rows.fetchall())
+
+	def done_ids(self, stage):
+		""" Ids whose stage finished. """
+		rows = self.conn.execute("SELECT id FROM jobs WHERE stage = ? AND status = 'done'", (stage,))
+		return {row[0] for row in rows}
+
+	def close(self):
+		self.conn.close()
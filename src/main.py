@@ -1,28 +1,206 @@
 from tqdm import tqdm
+from multiprocessing import Pool
 import argparse
-import os.path as op 
+import numpy as np
+import os
+import os.path as op
 import csv
 
 from shapes_classes import *
 from common_functions import *
+from renderers import MatplotlibRenderer, NumpyRenderer, frame_features
+from encoders import get_encoder, CODEC, FPS, BITRATE
+from tts import TTSCache, get_backend
+from jobs import JobDB, run_stage
+from metadata import load_metadata
+from shards import Shards
+from instrument import metrics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-d', '--data_path', type=str, default='./data/')
-parser.add_argument('-r', '--remove_old', action='store_true',
-	help='remove all old audio, video, and text files')
-args = parser.parse_args()
+# per-process state, set by init_worker
+worker = dict()
 
-setup_dirs(args.data_path, args.remove_old)
 
-metadata_file = op.join(args.data_path, 'metadata.json')
-texts_file = op.join(args.data_path, 'texts.csv')
+def main(argv=None):
+	args = get_args(argv)
+	setup_dirs(args.data_path, args.remove_old)
 
-with open(metadata_file, 'r') as rf:
-	metadata = json.load(rf)
+	texts_file = op.join(args.data_path, 'texts.csv')
+	metadata = load_metadata(args.data_path)
 
-type = TYPE[metadata['type']] 
-failed_ids = []
-for id, data in tqdm(metadata['content'].items()):
+	stages = {'mp4': ['video'], 'frames': ['frames'], 'both': ['video', 'frames']}[args.outputs]
+	stages = stages + ['audio']
+	if 'frames' in stages:
+		if args.renderer != 'numpy': perror('--outputs frames needs the numpy renderer')
+		os.makedirs(op.join(args.data_path, 'frames'), exist_ok=True)
+
+	# the request rate limit is shared out between the worker processes of all shards
+	tts_args = {'in_flight': args.tts_in_flight, 'rate': args.tts_rate / args.workers / args.num_shards,
+		'retries': args.tts_retries} if args.tts == 'gtts' else dict()
+	settings = {'type': metadata.type, 'data_path': args.data_path,
+		'renderer': args.renderer, 'antialias': not args.no_antialias,
+		'tts': args.tts, 'tts_args': tts_args, 'tts_cache': args.tts_cache,
+		'frames_pool': args.frames_pool, 'frames_dtype': args.frames_dtype,
+		'encoder': args.encoder, 'encoder_args': {'codec': args.codec, 'preset': args.preset,
+			'bitrate': args.bitrate, 'fps': args.fps},
+		'metrics': bool(args.metrics or args.profile), 'profile': args.profile,
+		'profile_every': args.profile_every}
+	ids = list(metadata)
+	shards, db_file = None, None
+	if args.num_shards > 1:
+		shards = Shards(args.data_path, args.shard, args.num_shards, len(ids),
+			args.batch_size, stages, args.claim_timeout)
+		db_file, texts_file = shards.file('jobs', 'sqlite'), shards.file('texts', 'csv')
+		shards.write_status()
+
+	# only ids with unfinished stages are handed out
+	db = JobDB(args.data_path, stages, db_file)
+	db.save_stages()
+	db.commit()
+	todo = db.pending(ids)
+	num_batches = -(-len(ids) // args.batch_size)
+	def batch_items(b):
+		positions = range(b * args.batch_size, min((b + 1) * args.batch_size, len(ids)))
+		positions = [k for k in positions if todo[ids[k]]]
+		if shards is not None and positions:
+			# a batch another shard gave back keeps the ids it finished
+			done = shards.done_elsewhere([ids[k] for k in positions])
+			positions = [k for k in positions if ids[k] not in done]
+		return [(ids[k], metadata.record(k), todo[ids[k]]) for k in positions]
+	if shards is None:
+		batches = ((b, items) for b in range(num_batches) for items in [batch_items(b)] if items)
+		total = sum(1 for id in ids if todo[id])
+	else:
+		# batches are claimed as they are handed out, so that idle shards can steal the rest
+		batches = ((b, batch_items(b)) for b in shards.batches())
+		# stolen batches are added to the total as they come back
+		total = sum(1 for b in shards.own() for id in shards.ids(b, ids) if todo[id])
+
+	# workers send their timings back with each batch, and only this process writes the sink
+	if settings['metrics']:
+		metrics.configure(args.metrics, args.profile, args.profile_every,
+			op.join(args.data_path, 'profiles'))
+
+	pool = None
+	if args.workers > 1:
+		pool = Pool(args.workers, initializer=init_worker, initargs=(settings,))
+		results = bounded_imap(pool, gen_numbered_batch, batches, 2 * args.workers)
+	else:
+		init_worker(settings)
+		results = map(gen_numbered_batch, batches)
+
+	failed_ids = []
+	with tqdm(total=total) as bar:
+		for b, batch, timings in results:
+			ok = True
+			for id, text, outcomes in batch:
+				for stage, result in outcomes.items():
+					db.record(id, stage, result)
+					if result['status'] != 'done': metrics.count(f'{stage}_failures')
+				db.set_caption(id, text)
+				if any(r['status'] != 'done' for r in outcomes.values()):
+					failed_ids.append(id)
+					ok = False
+			db.commit()
+			metrics.merge(timings)
+			metrics.flush()
+			if shards is not None:
+				shards.release(b, ok)
+				shards.write_status(failed_ids=len(failed_ids))
+				if b not in shards.own():
+					bar.total += len(batch)
+					bar.refresh()
+			bar.update(len(batch))
+			if failed_ids: bar.set_postfix(failed=len(failed_ids))
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+	write_texts(texts_file, db.captions(), ids)
+	db.close()
+	if shards is not None:
+		shards.close()
+		shards.write_status(state='finished')
+	metrics.print_summary()
+
+
+def get_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-d', '--data_path', type=str, default='./data/')
+	parser.add_argument('-r', '--remove_old', action='store_true',
+		help='remove all old audio, video, and text files')
+	parser.add_argument('--renderer', type=str, default='numpy', choices=['numpy', 'matplotlib'],
+		help='video backend; matplotlib is the slower FuncAnimation path')
+	parser.add_argument('--no_antialias', action='store_true',
+		help='disable anti-aliasing in the numpy renderer')
+	parser.add_argument('--encoder', type=str, default='auto', choices=['auto', 'pyav', 'ffmpeg'],
+		help='in-process pyav, one ffmpeg process per clip, or pyav if it is installed')
+	parser.add_argument('--codec', type=str, default=CODEC, help='ffmpeg video encoder name')
+	parser.add_argument('--preset', type=str, default=None, help='encoder preset, e.g. ultrafast')
+	parser.add_argument('--bitrate', type=int, default=BITRATE,
+		help='video bitrate in kbit/s; 0 for the encoder default')
+	parser.add_argument('--fps', type=int, default=FPS,
+		help='frames per second; motion is per frame, so this also speeds shapes up')
+	parser.add_argument('-o', '--outputs', type=str, default='mp4', choices=['mp4', 'frames', 'both'],
+		help='write video/{id}.mp4, frames/{id}.npy frame tensors (for create_pickle -v), or both')
+	parser.add_argument('--frames_pool', type=int, default=1,
+		help='mean-pool saved frames over blocks of this many pixels per side')
+	parser.add_argument('--frames_dtype', type=str, default='uint8', choices=['uint8', 'float16'],
+		help='dtype of saved frames; float16 is scaled to [0, 1]')
+	parser.add_argument('--tts', type=str, default='gtts', choices=['gtts', 'tone'],
+		help='TTS backend; tone is an offline deterministic stand-in')
+	parser.add_argument('--tts_in_flight', type=int, default=8,
+		help='max concurrent TTS requests per worker')
+	parser.add_argument('--tts_rate', type=float, default=5.,
+		help='max TTS requests per second over all workers and shards; 0 for no limit')
+	parser.add_argument('--tts_retries', type=int, default=5,
+		help='retries with exponential backoff for a failed TTS request')
+	parser.add_argument('--tts_cache', type=str, default='./data/tts_cache/',
+		help='dir of mp3s shared by all ids with the same utterance; empty to disable')
+	parser.add_argument('--shard', type=int, default=0,
+		help='index of this node, when several nodes share data_path')
+	parser.add_argument('--num_shards', '--num-shards', type=int, default=1,
+		help='number of nodes; shard outputs are combined by merge_shards.py')
+	parser.add_argument('--claim_timeout', type=float, default=3600,
+		help='seconds after which a batch claimed by another shard may be taken over')
+	parser.add_argument('--metrics', type=str, default='',
+		help='write per-id stage timings to this jsonl file, or totals to a Prometheus textfile if it ends in .prom')
+	parser.add_argument('--profile', type=str, default='', choices=['', 'cprofile', 'tracemalloc'],
+		help='profile sampled batches in the workers; written under data_path/profiles/')
+	parser.add_argument('--profile_every', type=int, default=100,
+		help='profile one in this many batches of each worker')
+	parser.add_argument('-w', '--workers', type=int, default=1,
+		help='number of worker processes')
+	parser.add_argument('-b', '--batch_size', type=int, default=16,
+		help='ids handed to a worker at a time; their audio is synthesized while videos render')
+	args = parser.parse_args(argv)
+	if not 0 <= args.shard < args.num_shards: perror(f'--shard must be in [0, {args.num_shards})')
+	if args.remove_old and args.num_shards > 1: perror('--remove_old would delete the outputs of other shards')
+	return args
+
+
+def init_worker(settings):
+	""" Build the per-process renderer, TTS backend and settings. """
+	worker.update(settings)
+	worker['type'] = TYPE[settings['type']]
+	if settings['renderer'] == 'numpy':
+		# the encoder lives as long as the worker, so pyav encodes every clip in-process
+		encoder = get_encoder(settings['encoder'], **settings['encoder_args'])
+		worker['renderer'] = NumpyRenderer(antialias=settings['antialias'], encoder=encoder)
+	else: worker['renderer'] = MatplotlibRenderer()
+
+	tts_args = settings['tts_args']
+	backend = get_backend(settings['tts'], **tts_args)
+	tts_cache = settings['tts_cache']
+	worker['tts'] = TTSCache(tts_cache, backend) if tts_cache else backend
+	worker['tts_pool'] = ThreadPoolExecutor(tts_args.get('in_flight', 4))
+	if settings['metrics'] and not metrics.enabled:
+		metrics.configure(None, settings['profile'], settings['profile_every'],
+			op.join(settings['data_path'], 'profiles'))
+
+
+def gen_shape(id, data):
 	shape = SHAPE[data['shape']]
 	fgcolor = FGCOLOR[data['fgcolor']]
 	bgcolor = BGCOLOR[data['bgcolor']]
@@ -31,32 +209,105 @@ for id, data in tqdm(metadata['content'].items()):
 	dir = DIR[data['dir']]
 	accent = ACCENT[data['accent']]
 
-	params = {'points': data['points'], 'type': type, 'shape': shape, 
-			'fgcolor': fgcolor, 'bgcolor': bgcolor, 'action': action, 'dir': dir, 
-			'speed': speed, 'id': id, 'accent': accent, 'data_path': args.data_path}
+	params = {'points': data['points'], 'type': worker['type'], 'shape': shape,
+			'fgcolor': fgcolor, 'bgcolor': bgcolor, 'action': action, 'dir': dir,
+			'speed': speed, 'id': id, 'accent': accent, 'data_path': worker['data_path']}
 
-	if shape in regular_polygons: s = RegularPolygon(**params)
-	elif shape in circular_shapes: s = Ellipse(**params)
+	if shape in regular_polygons: return RegularPolygon(**params)
+	elif shape in circular_shapes: return Ellipse(**params)
 	else: perror(f'main.py invalid shape: {shape}')
 
-	video_file = os.path.join(args.data_path, 'video', f'{id}.mp4')
-	audio_file = os.path.join(args.data_path, 'audio', f'{id}.mp3')
-	
-	text = s.gen_sentences()
-	save_text = True
-	try:
-		if not os.path.isfile(video_file):
-			v = s.gen_video(video_file, duration=data['duration'])
-			save_text = save_text and v
-		if not os.path.isfile(audio_file):
-			a = s.gen_audio(audio_file)
-			save_text = save_text and a
-
-	except Exception as e:
-		print(e)
-		continue
-		
-	if save_text:
-		with open(texts_file, 'a', newline='') as wf:
-			csv.writer(wf).writerow([id, text])
 
+def gen_batch(items):
+	""" Run the pending stages of a batch of ids; return [(id, caption, {stage: result})].
+
+	Audio of the whole batch is queued on the TTS threads first, so it is
+	synthesized while the videos render.
+	"""
+	data_path = worker['data_path']
+	tmp_path = op.join(data_path, 'tmp')
+	jobs = []
+	for id, data, stages in items:
+		s = gen_shape(id, data)
+		with metrics.timer('sentence', id):
+			text = s.gen_sentences()
+		futures = dict()
+		if 'audio' in stages:
+			audio_file = os.path.join(data_path, 'audio', f'{id}.mp3')
+			futures['audio'] = worker['tts_pool'].submit(run_stage, synthesize, audio_file, tmp_path, s)
+		jobs.append((id, data, stages, s, text, futures))
+
+	results = []
+	for id, data, stages, s, text, futures in jobs:
+		done = dict()
+		if 'frames' in stages:
+			# render once, for the frame tensor and the mp4 alike
+			try:
+				with metrics.timer('render', id):
+					clip = worker['renderer'].render_clip(s, data['duration'])
+			except Exception as e:
+				clip = e
+			frames_file = os.path.join(data_path, 'frames', f'{id}.npy')
+			done['frames'] = run_stage(save_frames, frames_file, tmp_path, id, clip)
+			if 'video' in stages:
+				video_file = os.path.join(data_path, 'video', f'{id}.mp4')
+				done['video'] = run_stage(save_video, video_file, tmp_path, id, clip)
+		elif 'video' in stages:
+			video_file = os.path.join(data_path, 'video', f'{id}.mp4')
+			done['video'] = run_stage(s.gen_video, video_file, tmp_path,
+				data['duration'], worker['renderer'])
+		for stage, future in futures.items():
+			done[stage] = future.result()
+		results.append((id, text, done))
+	return results
+
+
+def gen_numbered_batch(batch):
+	b, items = batch
+	with metrics.profiled(f'batch_{b}'):
+		results = gen_batch(items)
+	return b, results, metrics.drain()
+
+
+def bounded_imap(pool, func, iterable, depth):
+	""" pool.imap that takes at most depth items of iterable ahead of the results. """
+	pending = deque()
+	for x in iterable:
+		pending.append(pool.apply_async(func, (x,)))
+		if len(pending) >= depth: yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+
+def save_frames(filename, id, clip):
+	if isinstance(clip, Exception): raise clip
+	with metrics.timer('save', id):
+		np.save(filename, frame_features(clip, worker['frames_pool'], worker['frames_dtype']))
+
+
+def save_video(filename, id, clip):
+	if isinstance(clip, Exception): raise clip
+	r = worker['renderer']
+	with metrics.timer('encode', id):
+		r.encoder.encode(clip, filename, r.width, r.height)
+
+
+def synthesize(filename, s):
+	""" Like s.gen_audio, but errors propagate so that they are recorded. """
+	with metrics.timer('tts', s.id):
+		worker['tts'].save(s.audio_sentence, accent_to_args(s.accent), filename)
+
+
+def write_texts(texts_file, texts, ids):
+	""" Write texts.csv, one row per id in metadata order, replacing it atomically. """
+	tmp_file = texts_file + '.tmp'
+	with open(tmp_file, 'w', newline='') as wf:
+		writer = csv.writer(wf)
+		for id in ids:
+			if id in texts:
+				writer.writerow([id, texts[id]])
+	os.replace(tmp_file, texts_file)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,53 @@
+import os
+import os.path as op
+import argparse
+import json
+import csv
+from collections import defaultdict
+
+from metadata import load_metadata
+from shards import read_shard_texts
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--data_path', type=str, default='./data/')
+args = parser.parse_args()
+
+metadata = load_metadata(args.data_path)
+shards_path = op.join(args.data_path, 'shards')
+
+for name in sorted(os.listdir(shards_path)):
+	if name.startswith('status_') and name.endswith('.json'):
+		with open(op.join(shards_path, name)) as rf: s = json.load(rf)
+		print(f"shard {s['shard']} on {s['host']}: {s['state']}, {s['done']} batches done "
+			f"({s['stolen']} stolen), {s['failed_ids']} failed ids")
+
+# two shards that took over the same stale claim both have its ids; that is
+# only a problem if they disagree on a caption
+texts, shards_of, conflicts = dict(), defaultdict(list), set()
+for shard, id, caption in read_shard_texts(shards_path):
+	if texts.setdefault(id, caption) != caption: conflicts.add(id)
+	shards_of[id].append(shard)
+
+ids = list(metadata)
+missing = [id for id in ids if id not in texts]
+duplicates = {id: s for id, s in shards_of.items() if len(s) > 1}
+unknown = set(texts) - set(ids)
+print(f'{len(ids) - len(missing)}/{len(ids)} ids covered, {len(missing)} missing, '
+	f'{len(duplicates)} in several shards ({len(conflicts)} with different captions), '
+	f'{len(unknown)} not in metadata')
+for id in sorted(conflicts)[:10]:
+	print(f'  {id} has different captions in shards {duplicates[id]}')
+
+texts_file = op.join(args.data_path, 'texts.csv')
+with open(texts_file + '.tmp', 'w', newline='') as wf:
+	writer = csv.writer(wf)
+	for id in ids:
+		if id in texts:
+			writer.writerow([id, texts[id]])
+os.replace(texts_file + '.tmp', texts_file)
+
+# the ids to rerun, as gen_failed_ids_file.py writes them
+with open(op.join(args.data_path, 'failed_ids.json'), 'w') as wf:
+	json.dump(missing, wf, indent=2)
+
+if missing or conflicts or unknown: exit(1)
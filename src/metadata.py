@@ -0,0 +1,281 @@
+import numpy as np
+import os
+import os.path as op
+import json
+import math
+from itertools import product
+
+from core import *
+
+# categorical fields, stored as their enum values
+FIELDS = {'shape': SHAPE, 'fgcolor': FGCOLOR, 'bgcolor': BGCOLOR, 'action': ACTION,
+	'speed': SPEED, 'dir': DIR, 'accent': ACCENT}
+# (x, y, r, theta) for regular polygons, (x, y, w, h, degrees) for ellipses
+MAX_POINTS = 5
+CHUNK = 1 << 16
+
+START_ID = int(1e5)
+DURATION_SMALL, DURATION_BIG = 2.0, 5.0
+# the grids of circle_sampler
+CENTRES = np.arange(0.3, 0.75, 0.05)
+RADII = np.arange(0.1, 0.5, 0.05)
+# uniforms drawn per sample: x, y, r, theta or b, ellipse theta, duration, accent, spare
+DRAWS = 8
+
+
+def num_points(shape):
+	return 4 if shape in regular_polygons else 5
+
+
+class Columns:
+	""" Growable metadata columns, added a row or a block of rows at a time. """
+
+	def __init__(self):
+		self.chunks, self.sizes = [], []
+
+	def new_chunk(self):
+		chunk = {'id': np.empty(CHUNK, dtype=np.int64),
+			'points': np.full((CHUNK, MAX_POINTS), np.nan),
+			'duration': np.empty(CHUNK)}
+		for name in FIELDS: chunk[name] = np.empty(CHUNK, dtype=np.int8)
+		self.chunks.append(chunk)
+		self.sizes.append(0)
+
+	def add(self, id, d):
+		if not self.chunks or self.sizes[-1] == len(self.chunks[-1]['id']): self.new_chunk()
+		chunk, i = self.chunks[-1], self.sizes[-1]
+		chunk['id'][i] = int(id)
+		for name, enum in FIELDS.items():
+			chunk[name][i] = enum[d[name]].value
+		chunk['points'][i, :len(d['points'])] = d['points']
+		chunk['duration'][i] = d['duration']
+		self.sizes[-1] += 1
+
+	def add_block(self, block):
+		""" Add the rows of a dict of column arrays, as made by sample_block. """
+		self.chunks.append(block)
+		self.sizes.append(len(block['id']))
+
+	def arrays(self):
+		if not self.chunks: self.new_chunk()
+		return {k: np.concatenate([c[k][:n] for c, n in zip(self.chunks, self.sizes)])
+			for k in self.chunks[0]}
+
+
+class MetadataWriter:
+	""" Stream metadata records to {data_path}/metadata.{npz,jsonl,json}.
+
+	npz holds one column per field: int8 enum values, a (N, 5) float points
+	array padded with nan, durations and int64 ids. jsonl is a header line
+	with the seed and type, then one record per line. json is the original
+	single-object format and is built in memory.
+	"""
+
+	def __init__(self, data_path, type, seed, format='npz'):
+		self.file = op.join(data_path, FORMATS[format])
+		self.format, self.type, self.seed = format, type, seed
+		self.tmp_file = self.file + '.tmp'
+		if format == 'npz': self.columns = Columns()
+		elif format == 'jsonl':
+			self.wf = open(self.tmp_file, 'w')
+			self.wf.write(json.dumps({'seed': seed, 'type': type}) + '\n')
+		else: self.content = dict()
+
+	def add(self, id, d):
+		if self.format == 'npz': self.columns.add(id, d)
+		elif self.format == 'jsonl': self.wf.write(json.dumps({'id': id, **d}) + '\n')
+		else: self.content[id] = d
+
+	def add_block(self, block):
+		if self.format == 'npz': self.columns.add_block(block)
+		else:
+			for id, d in Metadata(self.seed, self.type, block).items():
+				self.add(int(id), d)
+
+	def close(self):
+		if self.format == 'npz':
+			with open(self.tmp_file, 'wb') as wf:
+				np.savez(wf, seed=self.seed, type=self.type, **self.columns.arrays())
+		elif self.format == 'jsonl': self.wf.close()
+		else:
+			with open(self.tmp_file, 'w') as wf:
+				json.dump({'seed': self.seed, 'type': self.type, 'content': self.content}, wf, indent=2)
+		os.replace(self.tmp_file, self.file)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class Metadata:
+	""" Columnar metadata of a dataset, see load_metadata.
+
+	Iterating gives the ids as strings, and record(i) the JSON-style dict of
+	the ith sample, which is only built on request. The columns (ids, the
+	enum fields, points, duration) can be used directly for vectorized work.
+	"""
+
+	def __init__(self, seed, type, columns):
+		self.seed, self.type = seed, type
+		self.columns = columns
+		self.ids = columns['id']
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __iter__(self):
+		return (str(id) for id in self.ids.tolist())
+
+	def __getitem__(self, name):
+		return self.columns[name]
+
+	def record(self, i):
+		d = dict()
+		for name, enum in FIELDS.items():
+			d[name] = enum(int(self.columns[name][i])).name
+		n = num_points(SHAPE(int(self.columns['shape'][i])))
+		d['points'] = self.columns['points'][i, :n].tolist()
+		d['duration'] = float(self.columns['duration'][i])
+		return {k: d[k] for k in ['shape', 'points', 'fgcolor', 'bgcolor', 'action',
+			'speed', 'dir', 'duration', 'accent']}
+
+	def items(self):
+		""" (id, record) pairs, built lazily. """
+		for i, id in enumerate(self):
+			yield id, self.record(i)
+
+
+def iter_jsonl(metadata_file):
+	""" The header, then (id, record) pairs of a metadata.jsonl file. """
+	with open(metadata_file) as rf:
+		yield json.loads(rf.readline())
+		for line in rf:
+			d = json.loads(line)
+			yield str(d.pop('id')), d
+
+
+def cache_file(metadata_file):
+	""" The npz columns of a jsonl or json metadata file, see load_metadata. """
+	return metadata_file + '.npz'
+
+
+def load_metadata(data_path):
+	""" Load metadata.npz, metadata.jsonl or metadata.json, in that order.
+
+	jsonl and json are parsed a record at a time, about 15s per million
+	records, so their columns are cached in metadata.{jsonl,json}.npz the
+	first time. The cache is reused while the file keeps its size and mtime.
+	"""
+	for format, name in FORMATS.items():
+		metadata_file = op.join(data_path, name)
+		if op.isfile(metadata_file): break
+	else: perror(f'no metadata file in {data_path}')
+
+	if format == 'npz':
+		with np.load(metadata_file) as f:
+			columns = {k: f[k] for k in f.files}
+		seed, type = int(columns.pop('seed')), str(columns.pop('type'))
+		return Metadata(seed, type, columns)
+
+	st = os.stat(metadata_file)
+	source = np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+	if op.isfile(cache_file(metadata_file)):
+		with np.load(cache_file(metadata_file)) as f:
+			columns = {k: f[k] for k in f.files}
+		if np.array_equal(columns.pop('source', None), source):
+			seed, type = int(columns.pop('seed')), str(columns.pop('type'))
+			return Metadata(seed, type, columns)
+
+	columns = Columns()
+	if format == 'jsonl':
+		records = iter_jsonl(metadata_file)
+		header = next(records)
+	else:
+		with open(metadata_file) as rf:
+			header = json.load(rf)
+		records = header.pop('content').items()
+	for id, d in records:
+		columns.add(id, d)
+	metadata = Metadata(header['seed'], header['type'], columns.arrays())
+
+	# several shards may load the metadata at once, so each writes its own tmp file
+	tmp_file = f'{cache_file(metadata_file)}.{os.getpid()}.tmp'
+	try:
+		with open(tmp_file, 'wb') as wf:
+			np.savez(wf, seed=metadata.seed, type=metadata.type, source=source, **metadata.columns)
+		os.replace(tmp_file, cache_file(metadata_file))
+	except OSError:
+		# a read-only dataset is parsed on every load
+		if op.isfile(tmp_file): os.remove(tmp_file)
+	return metadata
+
+
+def combos():
+	""" The (shape, fgcolor, bgcolor, speed, action, dir) of each sample group, in id order. """
+	out = []
+	for shape, fgcolor, bgcolor, speed in product(SHAPE, FGCOLOR, BGCOLOR, SPEED):
+		if shape == SHAPE.circle:
+			actions = [ACTION.shift, ACTION.grow, ACTION.jump]
+		else:
+			actions = [ACTION.rotate, ACTION.shift, ACTION.grow, ACTION.jump]
+
+		for action in actions:
+			if action == ACTION.shift: dirs = [DIR.right, DIR.left, DIR.up, DIR.down]
+			elif action == ACTION.rotate: dirs = [DIR.clock, DIR.anticlock]
+			elif action == ACTION.grow: dirs = [DIR.bigger, DIR.smaller]
+			elif action == ACTION.jump: dirs = [DIR.up]
+			else: perror('combos invalid action')
+			out += [(shape, fgcolor, bgcolor, speed, action, dir) for dir in dirs]
+	return out
+
+
+def sample_rng(seed, index):
+	""" Generator of sample index: a Philox stream keyed by seed, at counter index.
+
+	Each sample owns DRAWS uniforms (two Philox blocks), so sample k draws the
+	same numbers however the samples are split into blocks or shards.
+	"""
+	bit_generator = np.random.Philox(seed)
+	bit_generator.advance(index * DRAWS // 4)
+	return np.random.Generator(bit_generator)
+
+
+def sample_block(seed, start, stop, samples=1):
+	""" Metadata columns of samples start..stop-1, drawn all at once.
+
+	Sample k is the (k % samples)th sample of combos()[k // samples] and gets
+	id START_ID + k. Any block gives the same rows as the full range.
+	"""
+	table = np.array([[c.value for c in combo] for combo in combos()], dtype=np.int8)
+	k = np.arange(start, stop)
+	if stop > len(table) * samples: raise ValueError(f'only {len(table) * samples} samples')
+	shape, fgcolor, bgcolor, speed, action, dir = table[k // samples].T
+	u = sample_rng(seed, start).random((len(k), DRAWS))
+
+	# circle_sampler: centre on the grid, radius on the grid below the edge distance
+	x, y = CENTRES[(u[:, 0] * len(CENTRES)).astype(int)], CENTRES[(u[:, 1] * len(CENTRES)).astype(int)]
+	max_r = np.minimum(np.minimum(x, 1 - x), np.minimum(y, 1 - y))
+	r = RADII[(u[:, 2] * np.searchsorted(RADII, max_r)).astype(int)]
+
+	points = np.full((len(k), MAX_POINTS), np.nan)
+	points[:, 0], points[:, 1], points[:, 2] = x, y, r
+	polygon = np.isin(shape, [s.value for s in regular_polygons])
+	circle = shape == SHAPE.circle.value
+	ellipse = ~polygon & ~circle
+	points[polygon, 3] = 2 * math.pi * u[polygon, 3]
+	points[circle, 3], points[circle, 4] = r[circle], 0
+	# b in [a/3, 2a/3), theta in degrees
+	points[ellipse, 3] = r[ellipse] / 3 + u[ellipse, 3] * r[ellipse] / 3
+	points[ellipse, 4] = 360 * u[ellipse, 4]
+
+	accent = (np.array([a.value for a in ACCENT])[(u[:, 6] * len(ACCENT)).astype(int)]).astype(np.int8)
+	return {'id': START_ID + k, 'shape': shape, 'fgcolor': fgcolor, 'bgcolor': bgcolor,
+		'action': action, 'speed': speed, 'dir': dir, 'accent': accent, 'points': points,
+		'duration': DURATION_SMALL + u[:, 5] * (DURATION_BIG - DURATION_SMALL)}
+
+
+def sample_record(seed, index, samples=1):
+	""" The (id, record) of one sample, recomputed on its own. """
+	return next(Metadata(seed, None, sample_block(seed, index, index + 1, samples)).items())
@@ -0,0 +1,210 @@
+import numpy as np
+import os.path as op
+import subprocess
+import tempfile
+
+from core import *
+from trajectories import trajectory
+from encoders import FFmpegEncoder
+from instrument import metrics
+
+WIDTH, HEIGHT = 256, 256 # figsize=(4,4) at dpi=64
+# default subplot params of plt.figure(): the unit square is drawn in this box
+AXES_BOX = (0.125, 0.11, 0.9, 0.88) # left, bottom, right, top
+
+
+class MatplotlibRenderer:
+	""" The original FuncAnimation + FFMpegWriter path. """
+
+	def render(self, shape, filename, duration):
+		with metrics.timer('video', shape.id):
+			return shape.gen_video_mpl(filename, duration)
+
+
+class NumpyRenderer:
+	""" Rasterize shapes straight into uint8 RGB frames and hand them to an encoder.
+
+	Coverage is computed from the signed distance of every pixel centre to the
+	shape outline, so anti-aliasing costs nothing extra. Only the bounding box
+	of the shape is touched for each frame. Clips have the encoder's fps.
+	"""
+
+	def __init__(self, antialias=True, width=WIDTH, height=HEIGHT, encoder=None):
+		self.antialias = antialias
+		self.width, self.height = width, height
+		self.encoder = encoder or FFmpegEncoder()
+
+		left, bottom, right, top = AXES_BOX
+		self.x0, self.sx = left * width, (right - left) * width
+		self.y0, self.sy = bottom * height, (top - bottom) * height
+		self.box = (left * width, bottom * height, right * width, top * height)
+
+	def render(self, shape, filename, duration):
+		frames = self.gen_frames(shape, int(duration * self.encoder.fps))
+		# frames are rendered as the encoder pulls them, so split the time between the two
+		with metrics.timer('encode', shape.id) as timer:
+			frames = metrics.timed_iter('render', frames, shape.id, timer)
+			self.encoder.encode(frames, filename, self.width, self.height)
+		return True
+
+	def render_clip(self, shape, duration):
+		""" The whole clip as a (frames, height, width, 3) uint8 array. """
+		frames = int(duration * self.encoder.fps)
+		clip = np.empty((frames, self.height, self.width, 3), dtype=np.uint8)
+		for i, frame in enumerate(self.gen_frames(shape, frames)):
+			clip[i] = frame
+		return clip
+
+	def gen_frames(self, shape, frames):
+		""" Yield (height, width, 3) uint8 frames for the whole clip. """
+		fg = np.array(COLOR_RGB[shape.fgcolor.name], dtype=np.float32)
+		bg = np.array(COLOR_RGB[shape.bgcolor.name], dtype=np.uint8)
+		background = np.empty((self.height, self.width, 3), dtype=np.uint8)
+		background[:] = bg
+
+		traj = trajectory(shape.record, frames)
+		for (cx, cy), angle, (w, h) in zip(traj['center'], traj['angle'], traj['size']):
+			frame = background.copy()
+			if shape.shape in regular_polygons:
+				cov = self.polygon_coverage(cx, cy, w, angle, get_numpts(shape.shape))
+			else:
+				cov = self.ellipse_coverage(cx, cy, w, h, angle)
+
+			if cov is not None:
+				rows, cols, c = cov
+				region = frame[rows, cols].astype(np.float32)
+				region += (fg - region) * c[..., None]
+				frame[rows, cols] = np.rint(region).astype(np.uint8)
+			yield frame
+
+	def to_pixels(self, x, y):
+		""" Map data coords to pixel coords (y measured up from the bottom). """
+		return self.x0 + np.asarray(x) * self.sx, self.y0 + np.asarray(y) * self.sy
+
+	def grid(self, xmin, ymin, xmax, ymax):
+		""" Pixel centres inside a bounding box, clipped to the axes box. """
+		left, bottom, right, top = self.box
+		c0 = max(int(np.floor(max(xmin, left))) - 1, 0)
+		c1 = min(int(np.ceil(min(xmax, right))) + 1, self.width)
+		# rows count down from the top of the frame
+		r0 = max(self.height - int(np.ceil(min(ymax, top))) - 1, 0)
+		r1 = min(self.height - int(np.floor(max(ymin, bottom))) + 1, self.height)
+		if c0 >= c1 or r0 >= r1: return None
+
+		cols = np.arange(c0, c1)
+		rows = np.arange(r0, r1)
+		px = cols + 0.5
+		py = self.height - (rows + 0.5)
+
+		# patches are clipped to the axes box
+		if self.antialias:
+			cx = np.clip(np.minimum(cols + 1, right) - np.maximum(cols, left), 0, 1)
+			ry = self.height - rows
+			cy = np.clip(np.minimum(ry, top) - np.maximum(ry - 1, bottom), 0, 1)
+		else:
+			cx = ((px >= left) & (px < right)).astype(np.float32)
+			cy = ((py >= bottom) & (py < top)).astype(np.float32)
+		clip = np.outer(cy, cx).astype(np.float32)
+
+		X, Y = np.meshgrid(px, py)
+		return slice(r0, r1), slice(c0, c1), X, Y, clip
+
+	def coverage(self, dist, clip):
+		""" Turn a signed distance in pixels (positive outside) into coverage. """
+		if self.antialias: c = np.clip(0.5 - dist, 0, 1)
+		else: c = (dist <= 0).astype(np.float32)
+		return c * clip
+
+	def polygon_coverage(self, cx, cy, r, theta, numpts):
+		if r <= 0: return None
+		# same vertices as matplotlib's Path.unit_regular_polygon
+		t = 2 * np.pi / numpts * np.arange(numpts) + np.pi / 2 + theta
+		vx, vy = self.to_pixels(cx + r * np.cos(t), cy + r * np.sin(t))
+
+		g = self.grid(vx.min(), vy.min(), vx.max(), vy.max())
+		if g is None: return None
+		rows, cols, X, Y, clip = g
+
+		# vertices are anticlockwise, so (ey, -ex) points out of the polygon
+		ex, ey = np.roll(vx, -1) - vx, np.roll(vy, -1) - vy
+		norm = np.hypot(ex, ey)
+		nx, ny = ey / norm, -ex / norm
+		dist = (nx[:, None, None] * (X - vx[:, None, None])
+			+ ny[:, None, None] * (Y - vy[:, None, None])).max(axis=0)
+		return rows, cols, self.coverage(dist, clip)
+
+	def ellipse_coverage(self, cx, cy, w, h, angle):
+		if w <= 0 or h <= 0: return None
+		px, py = self.to_pixels(cx, cy)
+		ext = max(w, h) / 2
+		g = self.grid(px - ext * self.sx, py - ext * self.sy,
+			px + ext * self.sx, py + ext * self.sy)
+		if g is None: return None
+		rows, cols, X, Y, clip = g
+
+		# pixel offset -> unit circle coords: scale(2/w, 2/h) . rot(-angle) . data
+		c, s = np.cos(angle), np.sin(angle)
+		rot = np.array([[c, s], [-s, c]])
+		M = np.diag([2 / w, 2 / h]) @ rot @ np.diag([1 / self.sx, 1 / self.sy])
+		dx, dy = X - px, Y - py
+		u = M[0, 0] * dx + M[0, 1] * dy
+		v = M[1, 0] * dx + M[1, 1] * dy
+
+		# first order distance to the outline: f / |grad f|
+		f = u * u + v * v - 1
+		gx = 2 * (M[0, 0] * u + M[1, 0] * v)
+		gy = 2 * (M[0, 1] * u + M[1, 1] * v)
+		dist = f / np.maximum(np.hypot(gx, gy), 1e-6)
+		return rows, cols, self.coverage(dist, clip)
+
+
+def frame_features(clip, pool=1, dtype='uint8'):
+	""" Frame tensor saved in place of decoded video features.
+
+	Frames are mean-pooled over pool x pool pixel blocks; float16 features
+	are scaled to [0, 1].
+	"""
+	if pool > 1:
+		f, h, w, c = clip.shape
+		h, w = h // pool * pool, w // pool * pool
+		clip = clip[:, :h, :w].reshape(f, h // pool, pool, w // pool, pool, c) \
+			.mean(axis=(2, 4), dtype=np.float32)
+		if dtype == 'uint8': clip = np.rint(clip)
+	if dtype == 'float16': return (clip / np.float32(255)).astype(np.float16)
+	return clip.astype(np.uint8)
+
+
+def decode_clip(filename, width=WIDTH, height=HEIGHT):
+	""" Frames of an mp4 as a (frames, height, width, 3) uint8 array. """
+	cmd = ['ffmpeg', '-i', filename, '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+		'-hide_banner', '-loglevel', 'error', 'pipe:1']
+	proc = subprocess.run(cmd, capture_output=True)
+	if proc.returncode != 0:
+		raise RuntimeError(f'ffmpeg failed on {filename}: {proc.stderr.decode().strip()}')
+	return np.frombuffer(proc.stdout, dtype=np.uint8).reshape(-1, height, width, 3)
+
+
+def pixel_mismatch(shape, duration, tol=32, renderer=None):
+	""" Fraction of pixels where the numpy and gen_video_mpl clips differ by > tol.
+
+	Both clips are decoded from their mp4s: the reference from the real
+	FuncAnimation + FFMpegWriter output, and the numpy frames after the
+	renderer's encoder, so that the h264 loss at the shape edges is the same
+	on both sides. Frames missing from either clip count as mismatched.
+	"""
+	import matplotlib
+	matplotlib.use('Agg')
+
+	renderer = renderer or NumpyRenderer()
+	with tempfile.TemporaryDirectory() as tmp_path:
+		filename = op.join(tmp_path, 'mpl.mp4')
+		shape.gen_video_mpl(filename, duration)
+		ref = decode_clip(filename, renderer.width, renderer.height)
+		filename = op.join(tmp_path, 'numpy.mp4')
+		renderer.render(shape, filename, duration)
+		frames = decode_clip(filename, renderer.width, renderer.height)
+
+	n = min(len(frames), len(ref))
+	diff = np.abs(ref[:n].astype(np.int16) - frames[:n]).max(axis=-1)
+	bad = np.count_nonzero(diff > tol) + abs(len(frames) - len(ref)) * renderer.width * renderer.height
+	return bad / max(max(len(frames), len(ref)) * renderer.width * renderer.height, 1)
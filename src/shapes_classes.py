@@ -1,12 +1,12 @@
 import numpy as np
-import os.path as op
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import matplotlib.patches as patches
-from gtts import gTTS
-from numpy.random import randint, choice
+import os
 
 from common_functions import *
+from renderers import NumpyRenderer
+from trajectories import trajectory
+from encoders import FPS, BITRATE
+from tts import GTTSBackend
+from instrument import metrics
 
 
 class Shape:
@@ -61,27 +61,56 @@ class Shape:
 
 		return self.text_sentence
 
-	def gen_audio(self, filename):
+	def gen_audio(self, filename, tts=None):
 		if self.audio_sentence is None: self.gen_sentences()
+		if tts is None: tts = GTTSBackend()
 		try:
-			obj = gTTS(self.audio_sentence, **accent_to_args(self.accent))
-			obj.save(filename)
+			with metrics.timer('tts', self.id):
+				tts.save(self.audio_sentence, accent_to_args(self.accent), filename)
 			return True
 		except Exception as e:
 			print(e)
+			metrics.count('audio_failures')
 			if os.path.isfile(filename):
 				os.remove(filename)
 			return False
 
-	def gen_video(self, filename, func, duration):
+	@property
+	def record(self):
+		""" The metadata record fields that determine the motion. """
+		return {'shape': self.shape.name, 'points': self.points, 'action': self.action.name,
+			'speed': self.og_speed.name, 'dir': self.dir.name}
+
+	def gen_video(self, filename, duration, renderer=None):
+		if renderer is None: renderer = NumpyRenderer()
+		return renderer.render(self, filename, duration)
+
+	def gen_video_mpl(self, filename, duration):
+		""" The original FuncAnimation + FFMpegWriter path.
+
+		Frame i is set from the trajectory rather than stepped from the one
+		before, so it matches NumpyRenderer. FuncAnimation.save calls func(0)
+		several times, which the stepped animation funcs used to apply as
+		extra updates.
+		"""
+		# matplotlib is only loaded by this path
+		import matplotlib.pyplot as plt
+		import matplotlib.animation as animation
 		fig = plt.figure(figsize=(4,4), dpi=64)
-		self.ax = fig.gca()
+		ax = fig.gca()
 		plt.axis('off')
 		fig.patch.set_facecolor(self.bgcolor.name)
 
-		fps = 10; 
-		anim = animation.FuncAnimation(fig, func, frames=int(duration*fps), blit=True)
-		writer = animation.FFMpegWriter(fps=fps, bitrate=1800)
+		frames = int(duration * FPS)
+		traj = trajectory(self.record, frames)
+		patch = ax.add_patch(self.make_patch()) # a fresh patch keeps this safe to call again
+
+		def update(i):
+			self.set_state(patch, traj['center'][i], traj['angle'][i], traj['size'][i])
+			return [patch]
+
+		anim = animation.FuncAnimation(fig, update, frames=frames, init_func=lambda: update(0), blit=True)
+		writer = animation.FFMpegWriter(fps=FPS, bitrate=BITRATE)
 		anim.save(filename, writer=writer)
 		plt.close(fig)
 		return True
@@ -91,116 +120,45 @@ class RegularPolygon(Shape):
 	def __init__(self, points, type, shape, fgcolor, bgcolor, 
 				id, action, speed, dir, accent, data_path):
 		super().__init__(type, fgcolor, bgcolor, id, action, speed, dir, accent, data_path)
-		cx, cy, r, theta = points
 		self.shape = shape
-		self.patch = patches.RegularPolygon((cx, cy), get_numpts(shape),
-				radius=r, orientation=theta, facecolor=fgcolor.name) 
+		self.points = points
+
+	def make_patch(self):
+		import matplotlib.patches as patches
+		cx, cy, r, theta = self.points
+		return patches.RegularPolygon((cx, cy), get_numpts(self.shape),
+				radius=r, orientation=theta, facecolor=self.fgcolor.name) 
 
 	def gen_sentences(self):
 		return super().gen_sentences(self.shape)
 
-	def gen_audio(self, filename):
-		return super().gen_audio(filename)
-
-	def gen_video(self, filename, duration):
-		def shift(i):
-			if i == 0: self.ax.add_patch(self.patch)
-			(x, y) = self.patch.xy
-
-			if self.dir == DIR.right: x += self.speed
-			elif self.dir == DIR.left: x -= self.speed
-			elif self.dir == DIR.up: y += self.speed
-			elif self.dir == DIR.down: y -= self.speed
-			else: perror(f'triangle shift func invalid dir: {self.dir}')
-			self.patch.xy = (x, y)
-			return [self.patch]
-
-		def rotate(i):
-			if i == 0:
-				self.ax.add_patch(self.patch)
-				if self.dir == DIR.clock: self.speed *= -1
-				
-			self.patch.orientation += self.speed * np.pi
-			return [self.patch]
-			
-		def grow(i):
-			if i == 0:
-				self.ax.add_patch(self.patch)
-				if self.dir == DIR.smaller: self.speed *= -1
-			
-			if self.patch.radius >= 0.05:
-				self.patch.radius += self.speed
-			return [self.patch]
-		
-		def jump(i):
-			if i == 0: self.ax.add_patch(self.patch)
-			else: self.patch.xy = jump_update(self.patch.xy, i, self.og_speed)
-			return [self.patch]
-		
-		if self.action == ACTION.shift: super().gen_video(filename, shift, duration)
-		elif self.action == ACTION.rotate: super().gen_video(filename, rotate, duration)
-		elif self.action == ACTION.grow: super().gen_video(filename, grow, duration)
-		elif self.action == ACTION.jump: super().gen_video(filename, jump, duration)
-		else: perror(f'gen video RegularPolygon invalid action: {action}')	
+	def gen_audio(self, filename, tts=None):
+		return super().gen_audio(filename, tts)
+
+	def set_state(self, patch, center, angle, size):
+		patch.xy, patch.orientation, patch.radius = center, angle, size[0]
 
 
 class Ellipse(Shape):
 	def __init__(self, points, type, shape, fgcolor, bgcolor, 
 				id, action, speed, dir, accent, data_path):
 		super().__init__(type, fgcolor, bgcolor, id, action, speed, dir, accent, data_path)
-		x, y, w, h, theta = points
 		self.shape = shape
-		self.patch = patches.Ellipse((x, y), w, h, angle=theta, facecolor=fgcolor.name)
+		self.points = points
+
+	def make_patch(self):
+		import matplotlib.patches as patches
+		x, y, w, h, theta = self.points
+		return patches.Ellipse((x, y), w, h, angle=theta, facecolor=self.fgcolor.name)
 
 	def gen_sentences(self):
 		return super().gen_sentences(self.shape)
 
-	def gen_audio(self, filename):
-		return super().gen_audio(filename)
-
-	def gen_video(self, filename, duration):
-		def shift(i):
-			if i == 0: self.ax.add_patch(self.patch)
-			(cx, cy) = self.patch.get_center()
-			if self.dir == DIR.right: cx += self.speed
-			elif self.dir == DIR.left: cx -= self.speed
-			elif self.dir == DIR.up: cy += self.speed
-			elif self.dir == DIR.down: cy -= self.speed 
-			else: perror(f'triangle shift func invalid dir: {self.dir}')
-			self.patch.set_center((cx, cy))
-			return [self.patch]
-
-		def rotate(i):
-			if i == 0:
-				self.ax.add_patch(self.patch)
-				if self.dir == DIR.clock: self.speed *= -1
-			angle = self.patch.get_angle() 
-			self.patch.set_angle(angle + self.speed * 360)
-			return [self.patch]
-
-		def grow(i):
-			if i == 0:
-				self.ax.add_patch(self.patch)
-				if self.dir == DIR.smaller: self.speed *= -1
-
-			w, h = self.patch.get_width(), self.patch.get_height()
-			if max(w, h) >= 0.05:
-				h += (h/w) * self.speed
-				w += self.speed
-				self.patch.set_width(w)
-				self.patch.set_height(h)
-			return [self.patch]
-
-		def jump(i):
-			if i == 0: self.ax.add_patch(self.patch)
-			else:
-				(cx, cy) = self.patch.get_center()
-				(cx, cy) = jump_update((cx, cy), i, self.og_speed)
-				self.patch.set_center((cx, cy))
-			return [self.patch]
-		
-		if self.action == ACTION.shift: super().gen_video(filename, shift, duration)
-		elif self.action == ACTION.rotate: super().gen_video(filename, rotate, duration)
-		elif self.action == ACTION.grow: super().gen_video(filename, grow, duration)
-		elif self.action == ACTION.jump: super().gen_video(filename, jump, duration)
-		else: perror(f'gen video Ellipse invalid action: {action}')
\ No newline at end of file
+	def gen_audio(self, filename, tts=None):
+		return super().gen_audio(filename, tts)
+
+	def set_state(self, patch, center, angle, size):
+		patch.set_center(center)
+		patch.set_angle(np.rad2deg(angle))
+		patch.set_width(size[0])
+		patch.set_height(size[1])
@@ -0,0 +1,170 @@
+import os
+import os.path as op
+import json
+import time
+import csv
+
+from core import *
+from jobs import JobDB
+
+
+class Shards:
+	""" Work split of one dataset between num_shards nodes sharing data_path.
+
+	Ids are cut into batches of batch_size in metadata order, and shard i owns
+	a contiguous range of the batches. Every batch is claimed before it runs,
+	by exclusively creating shards/claims/{batch}, and gets a .done marker once
+	all its ids succeed. A shard that runs out of its own batches steals the
+	unclaimed batches of the others, last first, and can take over claims that
+	have not been touched for claim_timeout seconds (from a dead node).
+
+	Each shard keeps its own jobs_{shard}.sqlite, texts_{shard}.csv and
+	status_{shard}.json under shards/, which merge_shards.py combines. A batch
+	given back after a failure is picked up again by whichever shard claims
+	it, so done_elsewhere() tells the ids that another shard already finished.
+	"""
+
+	def __init__(self, data_path, shard, num_shards, num_ids, batch_size, stages, claim_timeout=3600):
+		self.data_path = data_path
+		self.stages = stages # the stages of the run, which every shard shares
+		self.path = op.join(data_path, 'shards')
+		self.others = dict() # job tables of the other shards, by file name
+		self.claims = op.join(self.path, 'claims')
+		os.makedirs(self.claims, exist_ok=True)
+		self.shard, self.num_shards = shard, num_shards
+		self.batch_size, self.claim_timeout = batch_size, claim_timeout
+		self.num_batches = -(-num_ids // batch_size)
+		self.check_layout(num_ids)
+		self.status = {'shard': shard, 'num_shards': num_shards, 'host': os.uname().nodename,
+			'pid': os.getpid(), 'state': 'running', 'own_batches': len(self.own()),
+			'done': 0, 'stolen': 0, 'failed_ids': 0, 'started': time.time()}
+
+	def check_layout(self, num_ids):
+		""" All shards must cut the ids the same way. """
+		layout = {'num_shards': self.num_shards, 'batch_size': self.batch_size, 'num_ids': num_ids}
+		layout_file = op.join(self.path, 'layout.json')
+		try:
+			fd = os.open(layout_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+			with os.fdopen(fd, 'w') as wf: json.dump(layout, wf)
+		except FileExistsError:
+			with open(layout_file) as rf: old = json.load(rf)
+			if old != layout:
+				perror(f'shard layout {layout} differs from {old} of {layout_file}')
+
+	def file(self, kind, ext):
+		return op.join(self.path, f'{kind}_{self.shard:03d}.{ext}')
+
+	def own(self):
+		start = self.shard * self.num_batches // self.num_shards
+		stop = (self.shard + 1) * self.num_batches // self.num_shards
+		return range(start, stop)
+
+	def ids(self, b, ids):
+		return ids[b * self.batch_size:(b + 1) * self.batch_size]
+
+	def claim_file(self, b):
+		return op.join(self.claims, f'{b:06d}')
+
+	def is_done(self, b):
+		return op.isfile(self.claim_file(b) + '.done')
+
+	def claim(self, b):
+		""" Try to take batch b; False if it is done or held by a live shard. """
+		if self.is_done(b): return False
+		claim_file = self.claim_file(b)
+		try:
+			fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except FileExistsError:
+			try:
+				stale = time.time() - op.getmtime(claim_file) > self.claim_timeout
+			except FileNotFoundError:
+				return self.claim(b)
+			if not stale or self.is_done(b): return False
+			# two shards may take over the same stale claim; the ids are
+			# then done twice, with the same outputs and captions, which the
+			# atomic output writes and merge_shards.py both accept
+			fd = os.open(claim_file, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+		with os.fdopen(fd, 'w') as wf: wf.write(f'{self.shard} {os.uname().nodename} {os.getpid()}\n')
+		return True
+
+	def release(self, b, ok):
+		""" Mark batch b done, or give it back if some of its ids failed.
+
+		Its finished ids stay done in the job table of this shard, so the
+		shard that claims it next only reruns the failed ones.
+		"""
+		if ok:
+			open(self.claim_file(b) + '.done', 'w').close()
+			self.status['done'] += 1
+		elif op.isfile(self.claim_file(b)): os.remove(self.claim_file(b))
+
+	def done_elsewhere(self, ids):
+		""" Those of ids that the job table of another shard has done, in every stage. """
+		own = op.basename(self.file('jobs', 'sqlite'))
+		for name in sorted(os.listdir(self.path)):
+			if name.startswith('jobs_') and name.endswith('.sqlite') and name != own \
+					and name not in self.others:
+				self.others[name] = JobDB(self.data_path, self.stages, op.join(self.path, name))
+		done = set()
+		for db in self.others.values():
+			done.update(id for id, todo in db.pending(ids).items() if not todo)
+		return done
+
+	def close(self):
+		for db in self.others.values(): db.close()
+
+	def release_stale(self):
+		""" Drop claims this shard left behind when it was last killed. """
+		for name in os.listdir(self.claims):
+			if name.endswith('.done'): continue
+			b = int(name)
+			try:
+				with open(self.claim_file(b)) as rf: owner = int(rf.read().split()[0])
+			except (FileNotFoundError, IndexError, ValueError):
+				continue
+			if owner == self.shard and not self.is_done(b): os.remove(self.claim_file(b))
+
+	def batches(self):
+		""" Claim and yield batch numbers: own batches first, then stolen ones. """
+		self.release_stale()
+		for b in self.own():
+			if self.claim(b): yield b
+		# other shards work through their ranges in order, so steal from the back
+		for j in range(1, self.num_shards):
+			s = (self.shard + j) % self.num_shards
+			start = s * self.num_batches // self.num_shards
+			stop = (s + 1) * self.num_batches // self.num_shards
+			for b in reversed(range(start, stop)):
+				if self.claim(b):
+					self.status['stolen'] += 1
+					yield b
+
+	def write_status(self, **kwargs):
+		self.status.update(kwargs, updated=time.time())
+		tmp_file = self.file('status', 'json.tmp')
+		with open(tmp_file, 'w') as wf: json.dump(self.status, wf, indent=2)
+		os.replace(tmp_file, self.file('status', 'json'))
+
+
+def reopen_batches(data_path, positions):
+	""" Drop the claims of the batches holding the ids at positions in metadata order.
+
+	The next sharded run then hands those batches out again, and reruns
+	whichever of their ids are not done.
+	"""
+	path = op.join(data_path, 'shards')
+	with open(op.join(path, 'layout.json')) as rf: batch_size = json.load(rf)['batch_size']
+	for b in sorted({k // batch_size for k in positions}):
+		claim_file = op.join(path, 'claims', f'{b:06d}')
+		for f in [claim_file + '.done', claim_file]:
+			if op.isfile(f): os.remove(f)
+
+
+def read_shard_texts(path):
+	""" (shard, id, caption) of every texts_{shard}.csv under path. """
+	for name in sorted(os.listdir(path)):
+		if not (name.startswith('texts_') and name.endswith('.csv')): continue
+		shard = int(name[len('texts_'):-len('.csv')])
+		with open(op.join(path, name), newline='') as rf:
+			for row in csv.reader(rf):
+				if row: yield shard, row[0], row[1]
@@ -0,0 +1,105 @@
+import numpy as np
+
+from core import *
+
+GROW_MIN = 0.05 # shapes stop shrinking once their size drops below this
+
+
+def trajectory(record, frames):
+	""" Per-frame motion of one metadata record, see batch_trajectories. """
+	traj = batch_trajectories([record], frames)
+	return {k: v[0] for k, v in traj.items() if k != 'mask'}
+
+
+def batch_trajectories(records, frames):
+	""" Closed-form per-frame centre, angle and size of many metadata records.
+
+	frames is an int or one count per record. Returns arrays padded to the
+	largest count: 'center' (N, F, 2), 'angle' (N, F) in radians and 'size'
+	(N, F, 2), which is (radius, radius) for regular polygons and
+	(width, height) for ellipses, plus a 'mask' (N, F) of real frames.
+
+	Frame i shows the state after i+1 updates of shift, rotate and grow, and
+	after i updates of jump, of the original animation funcs called once per
+	frame, with clock and smaller moving the negative way. Clips of the
+	original matplotlib path differ: FuncAnimation.save called func(0) four
+	times, which started them three updates ahead and, by negating the speed
+	each time, ran clock and smaller the wrong way.
+	"""
+	n = len(records)
+	frames = np.broadcast_to(np.asarray(frames, dtype=np.int64), (n,))
+	F = int(frames.max()) if n else 0
+
+	center0, angle0, size0 = np.zeros((n, 2)), np.zeros(n), np.zeros((n, 2))
+	velocity, spin, grow = np.zeros((n, 2)), np.zeros(n), np.zeros(n)
+	aspect = np.ones(n)
+	jump_g, jump_u = np.zeros(n), np.zeros(n)
+
+	for j, r in enumerate(records):
+		shape, action = SHAPE[r['shape']], ACTION[r['action']]
+		dir, og_speed = DIR[r['dir']], SPEED[r['speed']]
+		speed = speed_to_num(og_speed)
+		if dir in [DIR.clock, DIR.smaller]: speed = -speed
+
+		if shape in regular_polygons:
+			x, y, radius, theta = r['points']
+			center0[j], angle0[j], size0[j] = (x, y), theta, (radius, radius)
+			turn = np.pi # orientation += speed * pi
+		elif shape in circular_shapes:
+			x, y, w, h, degrees = r['points']
+			center0[j], angle0[j], size0[j] = (x, y), np.deg2rad(degrees), (w, h)
+			turn = 2 * np.pi # angle += speed * 360 degrees
+		else: perror(f'trajectory invalid shape: {shape}')
+
+		if action == ACTION.shift:
+			if dir == DIR.right: velocity[j] = (speed, 0)
+			elif dir == DIR.left: velocity[j] = (-speed, 0)
+			elif dir == DIR.up: velocity[j] = (0, speed)
+			elif dir == DIR.down: velocity[j] = (0, -speed)
+			else: perror(f'trajectory shift invalid dir: {dir}')
+		elif action == ACTION.rotate: spin[j] = speed * turn
+		elif action == ACTION.grow:
+			# the width grows by speed and the aspect ratio is kept
+			w, h = size0[j]
+			grow[j] = speed
+			aspect[j] = max(w, h) / w
+		elif action == ACTION.jump:
+			jump_g[j] = 0.005 if og_speed == SPEED.slow else 0.01
+			jump_u[j] = 0.05
+		else: perror(f'trajectory invalid action: {action}')
+
+	k = np.arange(1, F + 1, dtype=np.float64)[None]
+	center = center0[:, None] + k[..., None] * velocity[:, None]
+	center[..., 1] += jump_offset(jump_g[:, None], jump_u[:, None], k - 1)
+	angle = angle0[:, None] + k * spin[:, None]
+	size = grow_sizes(size0, grow, aspect, F)
+	mask = k < frames[:, None] + 1
+	return {'center': center, 'angle': angle, 'size': size, 'mask': mask}
+
+
+def grow_sizes(size0, step, aspect, F):
+	""" Sizes after each of F grow updates, which stop once max(w, h) < GROW_MIN.
+
+	The widths are a cumulative sum rather than w0 + k * step, so that they
+	round exactly like the animation's w += speed and stop on the same frame.
+	"""
+	n = len(size0)
+	steps = np.broadcast_to(step[:, None], (n, F))
+	widths = np.cumsum(np.concatenate([size0[:, :1], steps], axis=1), axis=1)
+	# update k+1 applies if the size after k updates is still large enough
+	applies = widths[:, :F] * aspect[:, None] >= GROW_MIN
+	count = np.cumsum(applies, axis=1)
+	w = np.take_along_axis(widths, count, axis=1)
+	return np.stack([w, w * (size0[:, 1] / size0[:, 0])[:, None]], axis=-1)
+
+
+def jump_offset(g, u, t):
+	""" Height gained after t jump_update steps, in closed form.
+
+	Steps rebound every P = int(2u/g) steps, and a step t' of a bounce moves
+	u - g(2t'-1)/2, so m steps of a bounce sum to mu - gm^2/2.
+	"""
+	P = np.maximum((2 * u / np.where(g > 0, g, 1)).astype(np.int64), 1)
+	q, m = t // P, t % P
+	bounce = lambda m: m * u - g * m * m / 2
+	return np.where(g > 0, q * bounce(P) + bounce(m), 0.)
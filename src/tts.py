@@ -0,0 +1,154 @@
+import os
+import os.path as op
+import json
+import time
+import zlib
+import random
+import shutil
+import hashlib
+import threading
+import subprocess
+import numpy as np
+
+from instrument import metrics
+
+
+class TokenBucket:
+	""" Allow rate calls per second on average, in bursts of up to burst. """
+
+	def __init__(self, rate, burst=1):
+		self.rate, self.burst = rate, burst
+		self.tokens = burst
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+				self.last = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+class GTTSBackend:
+	""" gTTS with a bounded number of in-flight requests, rate limiting and retries.
+
+	Safe to share between threads. A failed request is retried up to retries
+	times, sleeping backoff * 2^attempt seconds (with jitter) in between.
+	"""
+	name = 'gtts'
+
+	def __init__(self, in_flight=8, rate=5., retries=5, backoff=1.):
+		self.slots = threading.BoundedSemaphore(in_flight)
+		self.bucket = TokenBucket(rate, burst=in_flight) if rate > 0 else None
+		self.retries, self.backoff = retries, backoff
+
+	def save(self, sentence, args, filename):
+		from gtts import gTTS
+		for attempt in range(self.retries + 1):
+			try:
+				if self.bucket is not None: self.bucket.acquire()
+				with self.slots:
+					gTTS(sentence, **args).save(filename)
+				return
+			except Exception:
+				if attempt == self.retries: raise
+				metrics.count('tts_retries')
+				time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+
+class ToneBackend:
+	""" Offline stand-in for gTTS: a deterministic tone per word, saved as mp3.
+
+	The same (sentence, args) always gives the same samples, so it can be used
+	in tests and air-gapped runs. Needs ffmpeg with an mp3 encoder.
+	"""
+	name = 'tone'
+
+	def __init__(self, samplerate=24000, word_duration=0.25, gap=0.05):
+		self.samplerate = samplerate
+		self.word_duration, self.gap = word_duration, gap
+
+	def gen_samples(self, sentence, args):
+		seed = zlib.crc32(json.dumps([sentence, args], sort_keys=True).encode())
+		rng = np.random.default_rng(seed)
+		t = np.arange(int(self.word_duration * self.samplerate)) / self.samplerate
+		envelope = np.sin(np.pi * t / self.word_duration)
+		gap = np.zeros(int(self.gap * self.samplerate))
+
+		chunks = []
+		for word in sentence.split():
+			freq = 200 + zlib.crc32(word.encode()) % 600
+			chunks += [0.5 * envelope * np.sin(2 * np.pi * freq * t), gap]
+		samples = np.concatenate(chunks or [gap])
+		samples += 0.01 * rng.standard_normal(samples.shape[0])
+		return samples.astype(np.float32)
+
+	def save(self, sentence, args, filename):
+		samples = self.gen_samples(sentence, args)
+		cmd = ['ffmpeg', '-f', 'f32le', '-ar', str(self.samplerate), '-ac', '1',
+			'-i', 'pipe:', '-f', 'mp3', '-y', '-hide_banner', '-loglevel', 'error', filename]
+		proc = subprocess.run(cmd, input=samples.tobytes(), stderr=subprocess.PIPE)
+		if proc.returncode != 0:
+			raise RuntimeError(f'ffmpeg failed on {filename}: {proc.stderr.decode().strip()}')
+
+
+def get_backend(name, **kwargs):
+	if name == 'gtts': return GTTSBackend(**kwargs)
+	elif name == 'tone': return ToneBackend()
+	else: raise ValueError(f'unknown tts backend: {name}')
+
+
+class TTSCache:
+	""" Synthesize each unique (sentence, accent args) once and share the mp3.
+
+	Cached mp3s are named by a hash of the utterance, so one cache dir can be
+	shared by every dataset dir and run. Per-id files are hardlinks into the
+	cache, or copies where hardlinks are not possible. Wraps any backend.
+	"""
+
+	def __init__(self, path, backend=None):
+		os.makedirs(path, exist_ok=True)
+		self.path = path
+		self.backend = backend or GTTSBackend()
+		self.lock = threading.Lock()
+		self.key_locks = dict()
+
+	def key(self, sentence, args):
+		blob = json.dumps([self.backend.name, sentence, args], sort_keys=True)
+		return hashlib.sha1(blob.encode()).hexdigest()
+
+	def fetch(self, sentence, args):
+		""" Path of the cached mp3, synthesizing it on a miss. """
+		key = self.key(sentence, args)
+		cached = op.join(self.path, key + '.mp3')
+		if op.isfile(cached):
+			metrics.count('tts_cache_hits')
+			return cached
+
+		# threads wait for one synthesis per key; other processes may still
+		# race on it, which the atomic rename makes harmless
+		with self.lock: key_lock = self.key_locks.setdefault(key, threading.Lock())
+		with key_lock:
+			if not op.isfile(cached):
+				metrics.count('tts_cache_misses')
+				tmp = f'{cached}.{os.getpid()}.{threading.get_ident()}.tmp'
+				try:
+					self.backend.save(sentence, args, tmp)
+					os.replace(tmp, cached)
+				finally:
+					if op.isfile(tmp): os.remove(tmp)
+		return cached
+
+	def save(self, sentence, args, filename):
+		cached = self.fetch(sentence, args)
+		if op.lexists(filename): os.remove(filename)
+		try:
+			os.link(cached, filename)
+		except OSError:
+			shutil.copyfile(cached, filename)
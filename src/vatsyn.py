@@ -0,0 +1,37 @@
+import sys
+import os.path as op
+import argparse
+import importlib
+
+ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+# subcommand -> (dir, module, help); a module, and whatever it imports, only
+# loads when its subcommand runs, so metadata and failed-ids never touch
+# matplotlib, gTTS or torch
+COMMANDS = {
+	'metadata': ('src', 'gen_metadata', 'sample the metadata of a dataset'),
+	'generate': ('src', 'main', 'render the videos and synthesize the audio of the metadata'),
+	'failed-ids': ('src', 'gen_failed_ids_file', 'write failed_ids.json of ids with unfinished stages'),
+	'extract-audio': (op.join('feat-extract', 'audio'), 'extract_wav2vec', 'wav2vec2 features of the audio'),
+	'extract-video': (op.join('feat-extract', 'video'), 'extract_2d', '2D backbone features of the videos'),
+	'verify': ('src', 'verify', 'check the audio, video and frame outputs and list ids to regenerate'),
+	'pack': ('src', 'create_pickle', 'split features and captions into train/test pickles or shards'),
+}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog='vatsyn', formatter_class=argparse.RawDescriptionHelpFormatter,
+		epilog='commands:\n' + '\n'.join(f'  {c:<14} {h}' for c, (_, _, h) in COMMANDS.items())
+			+ '\n\nrun vatsyn <command> -h for the options of a command')
+	parser.add_argument('command', choices=list(COMMANDS), metavar='command')
+	parser.add_argument('args', nargs=argparse.REMAINDER, help='options of the command')
+	args = parser.parse_args(argv)
+
+	path, module, _ = COMMANDS[args.command]
+	sys.path.insert(0, op.join(ROOT, path))
+	# the command's own parser names itself after argv[0]
+	sys.argv = [f'vatsyn {args.command}'] + args.args
+	importlib.import_module(module).main(args.args)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,316 @@
+import os
+import os.path as op
+import ast
+import sys
+import json
+import time
+import struct
+import sqlite3
+import argparse
+import subprocess
+from multiprocessing import Pool
+
+from jobs import JobDB, STAGES, STAGE_FILES, shard_job_files
+from metadata import load_metadata
+from shards import reopen_batches
+
+FPS, WIDTH, HEIGHT = 10, 256, 256 # the defaults of encoders.py and renderers.py
+MIN_AUDIO = 0.1 # seconds
+
+# MPEG audio frame header tables, indexed by the header bits
+MP3_BITRATES = { # (version 1?, layer) -> kbit/s
+	(True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+	(True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+	(True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+	(False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+	(False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+	(False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+MP3_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def main(argv=None):
+	args = get_args(argv)
+	start = time.time()
+	metadata = load_metadata(args.data_path)
+	durations = dict(zip(metadata, metadata['duration'].tolist()))
+	stages = args.stages or [s for s in STAGES if op.isdir(op.join(args.data_path, STAGE_FILES[s][0]))]
+
+	# stat every output once; a cached probe is reused while size and mtime match
+	files = dict() # (id, stage) -> (path, size, mtime_ns), None if missing
+	for stage in stages:
+		dir, ext = STAGE_FILES[stage]
+		found = dict()
+		if op.isdir(op.join(args.data_path, dir)):
+			with os.scandir(op.join(args.data_path, dir)) as entries:
+				for e in entries:
+					if e.name.endswith('.' + ext):
+						st = e.stat()
+						found[e.name[:-len(ext) - 1]] = (e.path, st.st_size, st.st_mtime_ns)
+		for id in durations:
+			files[(id, stage)] = found.get(id)
+
+	cache = ProbeCache(args.cache or op.join(args.data_path, 'probe_cache.sqlite'), args.prober)
+	probes, todo = dict(), []
+	for key, f in files.items():
+		if f is None: continue
+		result = cache.get(*f)
+		if result is None: todo.append((f[0], key[1], args.prober))
+		else: probes[f[0]] = result
+	print(f'{len(files)} outputs, {len(probes)} cached probes, probing {len(todo)}')
+
+	if todo:
+		stats = {f[0]: f[1:] for f in files.values() if f is not None}
+		with Pool(args.workers) as pool:
+			for path, result in pool.imap_unordered(probe_file, todo, chunksize=64):
+				probes[path] = result
+				cache.put(path, *stats[path], result)
+	cache.close()
+
+	problems = dict() # id -> {stage: reason}
+	for (id, stage), f in files.items():
+		reason = 'missing' if f is None else check(stage, probes[f[0]], durations[id], args)
+		if reason: problems.setdefault(id, dict())[stage] = reason
+
+	regenerate = [id for id in durations if id in problems]
+	counts = dict()
+	for reasons in problems.values():
+		for stage, reason in reasons.items():
+			kind = f'{stage}: {reason.split(":")[0]}'
+			counts[kind] = counts.get(kind, 0) + 1
+	report = {'data_path': args.data_path, 'stages': stages, 'outputs': len(files),
+		'probed': len(todo), 'cached': len(files) - len(todo) - sum(f is None for f in files.values()),
+		'seconds': round(time.time() - start, 2), 'problems': counts,
+		'regenerate': regenerate, 'ids': problems}
+	report_file = args.output or op.join(args.data_path, 'verify_report.json')
+	with open(report_file, 'w') as wf:
+		json.dump(report, wf, indent=2)
+	for kind, n in sorted(counts.items()): print(f'{kind}: {n}')
+	print(f'{len(regenerate)} ids to regenerate, report in {report_file}')
+
+	if args.reset and regenerate:
+		# the next main.py run picks the bad stages up again, even where the size still matches
+		shards_path = op.join(args.data_path, 'shards')
+		if op.isdir(shards_path):
+			# a sharded run reads only the job tables under shards/, where any
+			# of them may say an id is done, and skips batches marked done
+			db_files = shard_job_files(args.data_path)
+			position = {id: k for k, id in enumerate(durations)}
+			reopen_batches(args.data_path, [position[id] for id in regenerate])
+		else: db_files = [None]
+		for db_file in db_files:
+			db = JobDB(args.data_path, db_file=db_file)
+			for id, reasons in problems.items():
+				for stage, reason in reasons.items():
+					db.invalidate(id, stage, f'verify: {reason}')
+			db.commit()
+			db.close()
+	if regenerate: sys.exit(1)
+
+
+def get_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-d', '--data_path', type=str, default='./data/')
+	parser.add_argument('-s', '--stages', type=str, nargs='*', choices=STAGES,
+		help='outputs to verify; all whose dir exists by default')
+	parser.add_argument('--prober', type=str, default='headers', choices=['headers', 'ffprobe'],
+		help='parse the mp3/mp4/npy headers in Python, or run ffprobe per file')
+	parser.add_argument('--fps', type=int, default=FPS, help='the --fps the videos were made with')
+	parser.add_argument('--width', type=int, default=WIDTH)
+	parser.add_argument('--height', type=int, default=HEIGHT)
+	parser.add_argument('--min_audio', type=float, default=MIN_AUDIO,
+		help='shortest plausible audio, in seconds')
+	parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+		help='processes probing files')
+	parser.add_argument('--cache', type=str, default='',
+		help='probe cache; data_path/probe_cache.sqlite by default')
+	parser.add_argument('-o', '--output', type=str, default='',
+		help='report file; data_path/verify_report.json by default')
+	parser.add_argument('--reset', action='store_true',
+		help='mark the bad stages not done in jobs.sqlite, or in every shards/jobs_*.sqlite of a '
+		'sharded run, so main.py redoes them')
+	return parser.parse_args(argv)
+
+
+class ProbeCache:
+	""" Probe results keyed on (path, size, mtime), in an sqlite file.
+
+	Results of another prober are not reused. All rows are read up front, so
+	lookups cost no queries.
+	"""
+
+	def __init__(self, cache_file, prober):
+		self.prober = prober
+		self.conn = sqlite3.connect(cache_file)
+		self.conn.execute('''CREATE TABLE IF NOT EXISTS probes (
+			path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, prober TEXT, result TEXT)''')
+		self.rows = {path: (size, mtime, result) for path, size, mtime, result in
+			self.conn.execute('SELECT path, size, mtime, result FROM probes WHERE prober = ?', (prober,))}
+		self.added = []
+
+	def get(self, path, size, mtime):
+		row = self.rows.get(path)
+		if row is None or row[0] != size or row[1] != mtime: return None
+		return json.loads(row[2])
+
+	def put(self, path, size, mtime, result):
+		self.added.append((path, size, mtime, self.prober, json.dumps(result)))
+		if len(self.added) >= 4096: self.flush()
+
+	def flush(self):
+		self.conn.executemany('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)', self.added)
+		self.conn.commit()
+		self.added = []
+
+	def close(self):
+		self.flush()
+		self.conn.close()
+
+
+def check(stage, probe, duration, args):
+	""" Why the probe of an output of a clip of duration seconds is bad, or None. """
+	if probe.get('error'): return probe['error']
+	if stage == 'audio':
+		if probe['duration'] < args.min_audio: return f'too short: {probe["duration"]:.2f}s'
+		return None
+	frames = int(duration * args.fps)
+	if stage == 'video':
+		if (probe['width'], probe['height']) != (args.width, args.height):
+			return f'resolution: {probe["width"]}x{probe["height"]}'
+	if probe['frames'] != frames: return f'frame count: {probe["frames"]}, expected {frames}'
+	return None
+
+
+def probe_file(job):
+	path, stage, prober = job
+	try:
+		if prober == 'ffprobe' and stage != 'frames': return path, probe_ffprobe(path, stage)
+		return path, {'audio': probe_mp3, 'video': probe_mp4, 'frames': probe_npy}[stage](path)
+	except Exception as e:
+		return path, {'error': f'unreadable: {e}'}
+
+
+def probe_mp3(path):
+	""" Walk the MPEG audio frames: {'duration', 'samplerate'}, or an error if cut short or corrupt. """
+	with open(path, 'rb') as rf: data = rf.read()
+	if not data: return {'error': 'empty'}
+	pos = 0
+	if data[:3] == b'ID3':
+		size = (data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | data[9] & 0x7f
+		pos = 10 + size + (10 if data[5] & 0x10 else 0)
+
+	frames, samples, rate = 0, 0, None
+	while pos + 4 <= len(data):
+		if data[pos:pos + 3] == b'TAG' and len(data) - pos == 128: break # ID3v1
+		h = int.from_bytes(data[pos:pos + 4], 'big')
+		version, layer = (h >> 19) & 3, 4 - ((h >> 17) & 3)
+		bitrate_index, rate_index = (h >> 12) & 15, (h >> 10) & 3
+		if h >> 21 != 0x7ff or version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+			return {'error': f'corrupt: no frame header at byte {pos}'}
+		v1 = version == 3
+		rate = MP3_RATES[version][rate_index]
+		bitrate = MP3_BITRATES[(v1, layer)][bitrate_index] * 1000
+		padding = (h >> 9) & 1
+		if layer == 1:
+			length, n = (12 * bitrate // rate + padding) * 4, 384
+		else:
+			n = 1152 if layer == 2 or v1 else 576
+			length = n // 8 * bitrate // rate + padding
+		if pos + length > len(data): return {'error': f'truncated: last frame ends past byte {len(data)}'}
+		# the Xing/Info frame of lame and ffmpeg carries no audio
+		if frames or (b'Xing' not in data[pos:pos + 64] and b'Info' not in data[pos:pos + 64]):
+			samples += n
+		frames += 1
+		pos += length
+	if not frames: return {'error': 'corrupt: no audio frames'}
+	return {'duration': samples / rate, 'samplerate': rate}
+
+
+def mp4_boxes(rf, start, end):
+	""" (type, payload start, box end) of the boxes in [start, end) of an mp4. """
+	pos = start
+	while pos + 8 <= end:
+		rf.seek(pos)
+		size, kind = struct.unpack('>I4s', rf.read(8))
+		header = 8
+		if size == 1:
+			size, header = struct.unpack('>Q', rf.read(8))[0], 16
+		elif size == 0: size = end - pos
+		if size < header: raise ValueError(f'bad {kind!r} box size {size} at byte {pos}')
+		yield kind.decode('latin1'), pos + header, pos + size
+		pos += size
+
+
+def probe_mp4(path):
+	""" {'duration', 'frames', 'width', 'height'} of the first video track, from the moov box. """
+	end = op.getsize(path)
+	if not end: return {'error': 'empty'}
+	with open(path, 'rb') as rf:
+		top = list(mp4_boxes(rf, 0, end))
+		if top and top[-1][2] > end: return {'error': f'truncated: {top[-1][0]} box ends past byte {end}'}
+		kinds = {kind: (s, e) for kind, s, e in top}
+		if 'moov' not in kinds or 'mdat' not in kinds:
+			return {'error': f'corrupt: no {"moov" if "moov" not in kinds else "mdat"} box'}
+
+		def child(parent, name):
+			for kind, s, e in mp4_boxes(rf, *parent):
+				if kind == name: return s, e
+			return None
+
+		def payload(box, n):
+			rf.seek(box[0])
+			return rf.read(min(n, box[1] - box[0]))
+
+		for kind, s, e in mp4_boxes(rf, *kinds['moov']):
+			if kind != 'trak': continue
+			mdia = child((s, e), 'mdia')
+			if mdia is None: continue
+			hdlr = child(mdia, 'hdlr')
+			if hdlr is None or payload(hdlr, 12)[8:12] != b'vide': continue
+			tkhd = payload(child((s, e), 'tkhd'), 128)
+			# width and height are the last two 16.16 fixed point fields
+			width, height = (x >> 16 for x in struct.unpack('>II', tkhd[-8:]))
+			mdhd = payload(child(mdia, 'mdhd'), 32)
+			if mdhd[0] == 1: timescale, duration = struct.unpack('>IQ', mdhd[20:32])
+			else: timescale, duration = struct.unpack('>II', mdhd[12:20])
+			stbl = child(child(mdia, 'minf'), 'stbl')
+			_, _, frames = struct.unpack('>III', payload(child(stbl, 'stsz'), 12))
+			return {'duration': duration / timescale, 'frames': frames, 'width': width, 'height': height}
+	return {'error': 'corrupt: no video track'}
+
+
+def probe_npy(path):
+	""" {'frames', 'shape', 'dtype'} from the .npy header, checking the data is all there. """
+	with open(path, 'rb') as rf:
+		magic = rf.read(8)
+		if magic[:6] != b'\x93NUMPY': return {'error': 'corrupt: not an npy file'}
+		header_len = int.from_bytes(rf.read(2 if magic[6] == 1 else 4), 'little')
+		header = ast.literal_eval(rf.read(header_len).decode('latin1'))
+		data_start = rf.tell()
+	shape = header['shape']
+	itemsize = int(header['descr'][2:])
+	expected = itemsize
+	for n in shape: expected *= n
+	if op.getsize(path) - data_start < expected: return {'error': 'truncated: data cut short'}
+	return {'frames': shape[0] if shape else 0, 'shape': list(shape), 'dtype': header['descr']}
+
+
+def probe_ffprobe(path, stage):
+	""" The same fields as the header probes, from ffprobe. """
+	cmd = ['ffprobe', '-v', 'error', '-count_packets', '-show_entries',
+		'stream=codec_type,width,height,nb_read_packets,duration:format=duration',
+		'-of', 'json', path]
+	proc = subprocess.run(cmd, capture_output=True, text=True)
+	if proc.returncode != 0: return {'error': f'unreadable: {proc.stderr.strip()}'}
+	info = json.loads(proc.stdout)
+	kind = 'audio' if stage == 'audio' else 'video'
+	streams = [s for s in info.get('streams', []) if s.get('codec_type') == kind]
+	if not streams: return {'error': f'corrupt: no {kind} stream'}
+	s = streams[0]
+	duration = float(s.get('duration') or info.get('format', {}).get('duration') or 0)
+	if stage == 'audio': return {'duration': duration}
+	return {'duration': duration, 'frames': int(s['nb_read_packets']),
+		'width': s['width'], 'height': s['height']}
+
+
+if __name__ == '__main__':
+	main()